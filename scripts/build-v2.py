@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import argparse
 import os
 import sys
 
@@ -20,8 +21,11 @@ from fontTools.misc.transform import Transform
 from robofab.objects.objectsRF import RPoint
 
 from fontbuild.Build import FontProject
+from fontbuild.buildCache import (
+    BuildCache, ItalicCache, MasterSnapshots, OverlapCache)
 from fontbuild.italics import condenseGlyph
 from fontbuild.italics import transformFLGlyphMembers
+from fontbuild.mix import DesignSpace
 from fontbuild.mix import Master
 from fontbuild.mix import Mix
 
@@ -29,11 +33,51 @@ from fontbuild.mix import Mix
 BASEDIR = os.path.abspath(
     os.path.join(os.path.dirname(__file__), os.pardir))
 
+parser = argparse.ArgumentParser(description="Build Roboto v2 instances.")
+parser.add_argument(
+    "-j", "--jobs", type=int, default=1,
+    help="number of instances to build in parallel (default: 1)")
+parser.add_argument(
+    "--ttf-jobs", type=int, metavar="JOBS",
+    help="number of TTFs to convert and compile in parallel, which bounds "
+         "how many fonts are open at once (default: same as --jobs)")
+parser.add_argument(
+    "--italic-jobs", type=int, default=1, metavar="JOBS",
+    help="number of processes italicizing the glyphs of each italic "
+         "instance; only used with --jobs 1 (default: 1)")
+parser.add_argument(
+    "--italic-batch", action="store_true",
+    help="italicize the glyphs of each italic instance together, solving "
+         "one system per pass instead of one per glyph")
+parser.add_argument(
+    "--no-cache", action="store_true",
+    help="rebuild everything instead of reusing outputs of earlier builds")
+parser.add_argument(
+    "--in-memory", action="store_true",
+    help="compile OTFs and TTFs from the fonts in memory, saving the UFOs "
+         "in the background")
+parser.add_argument(
+    "--no-ufo", action="store_true",
+    help="with --in-memory, don't save the UFOs at all")
+parser.add_argument(
+    "--variable", action="store_true",
+    help="also build a variable TTF with the upright, uncondensed styles")
+parser.add_argument(
+    "--trace", metavar="FILE", default="out/build-trace.json",
+    help="where to save the timings of the build stages, in Chrome's trace "
+         "event format (default: %(default)s)")
+args = parser.parse_args()
+
 # Masters
 
-rg = Master("%s/src/v2/Roboto-Regular.ufo" % BASEDIR)
-bd = Master("%s/src/v2/Roboto-Bold.ufo" % BASEDIR)
-th = Master("%s/src/v2/Roboto-Thin.ufo" % BASEDIR)
+snapshots = None
+if not args.no_cache:
+    snapshots = MasterSnapshots(
+        os.path.join(BASEDIR, "out", "cache", "masters"))
+
+rg = Master("%s/src/v2/Roboto-Regular.ufo" % BASEDIR, snapshots=snapshots)
+bd = Master("%s/src/v2/Roboto-Bold.ufo" % BASEDIR, snapshots=snapshots)
+th = Master("%s/src/v2/Roboto-Thin.ufo" % BASEDIR, snapshots=snapshots)
 
 lessCondensed = (
     "plusminus bracketleft bracketright dieresis macron "
@@ -82,8 +126,30 @@ proj = FontProject(rg.font, BASEDIR, "res/roboto.cfg")
 FAMILYNAME = "Roboto"
 
 proj.buildOTF = True
+proj.workers = args.jobs
+proj.ttfWorkers = args.ttf_jobs
+proj.italicWorkers = args.italic_jobs
+proj.italicBatch = args.italic_batch
+proj.inMemory = args.in_memory
+proj.saveUFO = not args.no_ufo
+if not args.no_cache:
+    proj.cache = BuildCache(os.path.join(BASEDIR, proj.builddir, "cache"))
+    proj.overlapCache = OverlapCache(
+        os.path.join(BASEDIR, proj.builddir, "cache", "overlaps"))
+    proj.italicCache = ItalicCache(
+        os.path.join(BASEDIR, proj.builddir, "cache", "italics"))
+    proj.masterSnapshots = snapshots
+proj.traceFile = os.path.join(BASEDIR, args.trace)
 #proj.compatible = True
 
+# the other weights are condensed by what condensing does to Thin
+thcn1 = Master(condenseFont(th.font, .84, 40))
+space = DesignSpace(
+    [th, rg, bd, thcn1],
+    [{}, {"weight": 1}, {"weight": 2}, {"width": 1}])
+
+proj.checkCompatibility([[th, rg], [rg, bd], space.masters])
+
 proj.generateFont(th.font, "%s/Thin/Regular/Th" % FAMILYNAME)
 proj.generateFont(Mix([th, rg], 0.45), "%s/Light/Regular/Lt" % FAMILYNAME)
 proj.generateFont(Mix([th, rg], RPoint(0.90, 0.92)),
@@ -115,34 +181,45 @@ proj.generateFont(Mix([rg, bd], RPoint(1.125, 1.0)),
 # their original forms, so we can't convert all fonts together compatibly
 proj.generateTTFs()
 
-thcn1 = Master(condenseFont(th.font, .84, 40))
-cn1 = Master(rg.ffont.addDiff(thcn1.ffont, th.ffont))
-bdcn1 = Master(bd.ffont.addDiff(thcn1.ffont, th.ffont))
-
-proj.generateFont(Mix([thcn1, cn1], RPoint(0.45, 0.47)),
+if args.variable:
+    # Thin is mixed too, so that its glyphs are built like the other masters'
+    proj.generateVariableFont([
+        (Mix([th, rg], 0), "%s/Thin/Regular/Th" % FAMILYNAME, 100),
+        (Mix([th, rg], 0.45), "%s/Light/Regular/Lt" % FAMILYNAME, 300),
+        (Mix([th, rg], RPoint(0.90, 0.92)),
+         "%s/Regular/Regular/Rg" % FAMILYNAME, 400),
+        (Mix([rg, bd], 0.35), "%s/Medium/Regular/Lt" % FAMILYNAME, 500),
+        (Mix([rg, bd], RPoint(0.73, 0.73)), "%s/Bold/Bold/Rg" % FAMILYNAME,
+         700),
+        (Mix([rg, bd], RPoint(1.125, 1.0)),
+         "%s/Black/Regular/Bk" % FAMILYNAME, 900)])
+
+proj.generateFont(Mix(space, {"weight": RPoint(0.45, 0.47), "width": 1}),
                   "%s Condensed/Light/Regular/Lt" % FAMILYNAME,
                   swapSuffixes=[".cn"])
-proj.generateFont(Mix([thcn1, cn1], RPoint(0.9, 0.92)),
+proj.generateFont(Mix(space, {"weight": RPoint(0.9, 0.92), "width": 1}),
                   "%s Condensed/Regular/Regular/Rg" % FAMILYNAME,
                   swapSuffixes=[".cn"])
-proj.generateFont(Mix([cn1, bdcn1], 0.4),
+proj.generateFont(Mix(space, {"weight": 1.4, "width": 1}),
                   "%s Condensed/Medium/Regular/Lt"%FAMILYNAME,
                   swapSuffixes=[".cn"])
-proj.generateFont(Mix([cn1, bdcn1], RPoint(0.75, 0.75)),
+proj.generateFont(Mix(space, {"weight": 1.75, "width": 1}),
                   "%s Condensed/Bold/Bold/Rg" % FAMILYNAME,
                   swapSuffixes=[".cn"])
 
-proj.generateFont(Mix([thcn1, cn1], RPoint(0.45, 0.47)),
+proj.generateFont(Mix(space, {"weight": RPoint(0.45, 0.47), "width": 1}),
                   "%s Condensed/Light Italic/Italic/Lt" % FAMILYNAME,
                   italic=True, swapSuffixes=[".cn"], stemWidth=120)
-proj.generateFont(Mix([thcn1, cn1], RPoint(0.9, 0.92)),
+proj.generateFont(Mix(space, {"weight": RPoint(0.9, 0.92), "width": 1}),
                   "%s Condensed/Italic/Italic/Rg" % FAMILYNAME,
                   italic=True, swapSuffixes=[".cn"], stemWidth=185)
-proj.generateFont(Mix([cn1, bdcn1], 0.4),
+proj.generateFont(Mix(space, {"weight": 1.4, "width": 1}),
                   "%s Condensed/Medium Italic/Italic/Lt"%FAMILYNAME,
                   italic=True, swapSuffixes=[".cn"], stemWidth=230)
-proj.generateFont(Mix([cn1, bdcn1], RPoint(0.75, 0.75)),
+proj.generateFont(Mix(space, {"weight": 1.75, "width": 1}),
                   "%s Condensed/Bold Italic/Bold Italic/Rg" % FAMILYNAME,
                   italic=True, swapSuffixes=[".cn"], stemWidth=240)
 
 proj.generateTTFs()
+
+proj.report()
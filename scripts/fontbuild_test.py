@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the fontbuild library, on small fonts made in memory."""
+
+import unittest
+
+from robofab.objects.objectsRF import RFont
+
+from fontbuild.mix import DesignSpace, Master
+
+
+def makeMaster(glyphs):
+    """Return a Master of a font with glyphs given as lists of contours,
+    each a list of (x, y) line points."""
+
+    font = RFont()
+    font.info.postscriptStemSnapH = []
+    font.info.postscriptStemSnapV = []
+    for name, contours in glyphs.items():
+        g = font.newGlyph(name)
+        pen = g.getPen()
+        for contour in contours:
+            pen.moveTo(contour[0])
+            for pt in contour[1:]:
+                pen.lineTo(pt)
+            pen.closePath()
+    return Master(font)
+
+
+def square(size):
+    return [(0, 0), (size, 0), (size, size), (0, size)]
+
+
+class DesignSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        # "b" has an extra contour in the condensed master
+        self.masters = [
+            makeMaster({"a": [square(10)], "b": [square(10)]}),
+            makeMaster({"a": [square(30)], "b": [square(30)]}),
+            makeMaster({"a": [square(20)],
+                        "b": [square(20), square(5)]}),
+        ]
+        self.space = DesignSpace(
+            self.masters, [{}, {"weight": 1}, {"width": 1}])
+
+    def testMixesCompatibleGlyphs(self):
+        g = self.space.mixGlyph("a", {"weight": .5})
+        self.assertEqual(list(g.dataX), [0, 0, 20, 20, 0])
+        self.assertEqual(list(g.dataY), [0, 0, 20, 20])
+
+    def testIncompatibleGlyphFromNearestMaster(self):
+        bold = self.space.mixGlyph("b", {"weight": .9})
+        self.assertEqual(list(bold.dataX), [0, 0, 30, 30, 0])
+        condensed = self.space.mixGlyph("b", {"width": .8})
+        self.assertEqual(len(condensed.contours), 2)
+        default = self.space.mixGlyph("b", {"weight": .2, "width": .1})
+        self.assertEqual(list(default.dataX), [0, 0, 10, 10, 0])
+
+    def testMissingGlyph(self):
+        self.assertIsNone(self.space.mixGlyph("c", {"weight": .5}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,23 +14,39 @@
 
 
 import ConfigParser
+import errno
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree
 
 from booleanOperations import BooleanOperationManager
 from cu2qu.ufo import fonts_to_quadratic
+from fontTools import varLib
 from fontTools.misc.transform import Transform
+from robofab.glifLib import GlyphSet
 from robofab.world import OpenFont
 from ufo2ft import compileOTF, compileTTF
 
+from fontbuild.buildCache import (
+    hashCode, hashData, hashFiles, hashFontData, hashInstanceGlyphs,
+    hashMasterData, memoHash, mixFactors)
 from fontbuild.decomposeGlyph import decomposeGlyph
+from fontbuild.dependencyGraph import GlyphDependencyGraph
 from fontbuild.features import readFeatureFile, writeFeatureFile
 from fontbuild.generateGlyph import generateGlyph
 from fontbuild.instanceNames import setNamesRF
-from fontbuild.italics import italicizeGlyph
+from fontbuild.italics import (
+    italicizeContourBatch, italicizeContours, italicizeGlyph, packContours)
 from fontbuild.markFeature import RobotoFeatureCompiler, RobotoKernWriter
 from fontbuild.mitreGlyph import mitreGlyph
-from fontbuild.mix import Mix,Master,narrowFLGlyph
+from fontbuild.mix import Mix,Master,compatibilityIndex,narrowFLGlyph
+from fontbuild.overlaps import hasOverlaps
+from fontbuild.trace import BuildTrace
 
 
 class FontProject:
@@ -67,7 +83,37 @@ class FontProject:
 
         self.buildOTF = False
         self.compatible = False
+        self.workers = 1
+        # workers converting and compiling TTFs, which is also how many fonts
+        # are open at once; defaults to the number of workers
+        self.ttfWorkers = None
+        # workers italicizing the glyphs of an instance; only used when the
+        # instance is built in this process, as pools can't be nested
+        self.italicWorkers = 1
+        # italicize the glyphs of an instance with a single system per pass
+        # (one per worker and angle) rather than one per glyph
+        self.italicBatch = False
+        self.cache = None
+        # results of overlap removal kept across instances and builds
+        self.overlapCache = None
+        # italicized contours kept across instances and builds
+        self.italicCache = None
+        # snapshots the masters were loaded from, only to be reported
+        self.masterSnapshots = None
+        self.trace = BuildTrace()
+        self.traceFile = None
+        # hand fonts from generateFont to generateTTFs without reading them
+        # back from disk; the UFOs are then saved in the background, if at all
+        self.inMemory = False
+        self.saveUFO = True
+        self.openFonts = {}
+        self.saveThreads = {}
+        # cache entries to store once the UFOs they include are saved
+        self.pendingStores = {}
         self.generatedFonts = []
+        self.queuedFonts = []
+        # cache keys of the generated UFOs, which the TTF keys derive from
+        self.ufoKeys = {}
 
     def openResource(self, name):
         with open(os.path.join(
@@ -80,18 +126,226 @@ class FontProject:
         style = font.info.styleName.replace(" ", "")
         path = os.path.join(self.basedir, self.builddir, family + ext.upper())
         if not os.path.exists(path):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # another worker may have created it in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
         return os.path.join(path, "%s-%s.%s" % (family, style, ext))
 
+    def outputDir(self):
+        return os.path.join(self.basedir, self.builddir)
+
+    def instanceComponents(self, mix, names, italic, swapSuffixes, stemWidth,
+                           glyphDigests):
+        """Digest everything an instance depends on, to key the build cache.
+
+        Glyph data is only represented by the "glyphs" component, so that
+        changes limited to glyphs can be told apart from all others.
+        """
+
+        if isinstance(mix, Mix):
+            masters = hashData([hashMasterData(m) for m in mix.masters])
+            mixFactor = hashData(*mixFactors(mix))
+        else:
+            masters = memoHash(mix, hashFontData)
+            mixFactor = hashData(None)
+        resources = [
+            os.path.join(self.basedir, self.config.get("res", name))
+            for name in sorted(self.config.options("res"))]
+        return {
+            "glyphs": hashData(sorted(glyphDigests.items())),
+            "masters": masters,
+            "basefont": memoHash(self.basefont, hashFontData),
+            "mix": mixFactor,
+            "arguments": hashData(names, italic, swapSuffixes, stemWidth,
+                                  self.buildOTF, self.compatible),
+            "config": hashFiles([self.configfile]),
+            "resources": hashFiles(resources),
+            "code": hashCode()}
+
+    def reusableBuild(self, mix, names, swapSuffixes, components,
+                      glyphDigests):
+        """Find what to rebuild if only some glyphs changed since last build.
+
+        Returns the UFO from the last build of this instance, the glyphs whose
+        output may have changed, and the glyphs which have to go through every
+        build stage to rebuild those. Returns None if the whole instance has
+        to be rebuilt.
+        """
+
+        previous = self.cache.previous("instance", names)
+        if previous is None:
+            return None
+        key, manifest = previous
+        previousDigests = (manifest.get("data") or {}).get("glyphs")
+        changedComponents = [c for c in components
+                             if components[c] != manifest["components"].get(c)]
+        if (previousDigests is None or changedComponents != ["glyphs"] or
+                set(previousDigests) != set(glyphDigests)):
+            return None
+
+        changed = set(name for name, digest in glyphDigests.iteritems()
+                      if previousDigests[name] != digest)
+        source = self.basefont if isinstance(mix, Mix) else mix
+        graph = GlyphDependencyGraph()
+        graph.addComponents(source)
+        graph.addCompositeRules(self.diacriticList)
+        graph.addSwaps(source.keys(), swapSuffixes or [])
+        affected = graph.affectedBy(changed)
+        previousUFO = self.cache.entryPath(
+            "instance", key, manifest["files"]["ufo"])
+        return previousUFO, affected, graph.requiredFor(affected)
+
+    def checkCompatibility(self, masterSets):
+        """Log which glyphs of each list of masters can't be interpolated.
+
+        Indexes the masters for the instances mixing them, which leave those
+        glyphs as they are in their first (or default) master.
+        """
+
+        log(">> Checking master compatibility")
+        for masters in masterSets:
+            for line in compatibilityIndex(masters).report():
+                log(line)
+
     def generateFont(self, mix, names, italic=False, swapSuffixes=None, stemWidth=185):
+        """Build an instance, or queue it if building with several workers.
+
+        Queued instances are built by runQueuedFonts, which generateTTFs calls
+        before converting anything.
+        """
+
+        if self.workers > 1:
+            self.queuedFonts.append(
+                (mix, names, italic, swapSuffixes, stemWidth))
+        else:
+            self.generatedFonts.append(self.buildFont(
+                mix, names, italic, swapSuffixes, stemWidth))
+
+    def runQueuedFonts(self):
+        """Build all queued instances on a pool of worker processes.
+
+        The workers are forked after the masters have been loaded, so they
+        share the masters with this process instead of reopening them. The
+        generated UFOs are recorded in queue order, same as a serial build.
+        """
+
+        if not self.queuedFonts:
+            return
+        log(">> Building %d instances with %d workers" % (
+            len(self.queuedFonts), min(self.workers, len(self.queuedFonts))))
+        self.generatedFonts.extend(self.runOnPool(
+            _buildQueuedFont, self.queuedFonts, self.workers))
+        self.queuedFonts = []
 
+    def runOnPool(self, function, tasks, workers):
+        """Call function(project, *task) for each task on worker processes.
+
+        The workers are forked with a copy of this project, and whatever they
+        record for the build report is merged back into it. Returns the
+        results in task order.
+        """
+
+        global _poolProject, _poolTasks
+        # threads don't survive forking, so background saves must be done
+        self.finishSaving()
+        _poolProject, _poolTasks = self, (function, tasks)
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_runPoolTask, range(len(tasks)), chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _poolProject, _poolTasks = None, None
+
+        for result, state in results:
+            self.mergeWorkerState(state)
+        return [result for result, state in results]
+
+    def takeWorkerState(self):
+        """Return and reset what a worker recorded for the parent process."""
+
+        state = {"ufoKeys": self.ufoKeys, "traceEvents": self.trace.events}
+        self.ufoKeys = {}
+        self.trace.events = []
+        if self.cache is not None:
+            state["cacheEvents"] = self.cache.events
+            self.cache.events = []
+        if self.overlapCache is not None:
+            state["overlapCache"] = self.overlapCache.takeState()
+        if self.italicCache is not None:
+            state["italicCache"] = self.italicCache.takeState()
+        return state
+
+    def mergeWorkerState(self, state):
+        self.ufoKeys.update(state["ufoKeys"])
+        self.trace.events.extend(state["traceEvents"])
+        if self.cache is not None:
+            self.cache.events.extend(state["cacheEvents"])
+        if self.overlapCache is not None:
+            self.overlapCache.mergeState(state["overlapCache"])
+        if self.italicCache is not None:
+            self.italicCache.mergeState(state["italicCache"])
+
+    def buildFont(self, mix, names, italic=False, swapSuffixes=None, stemWidth=185):
+        """Build an instance right away and return the path of its UFO."""
+
+        with self.trace.span("instance", instance=names):
+            return self._buildFont(mix, names, italic, swapSuffixes, stemWidth)
+
+    def _buildFont(self, mix, names, italic, swapSuffixes, stemWidth):
+        span = self.trace.span
         n = names.split("/")
         log("---------------------\n%s %s\n----------------------" %(n[0],n[1]))
+
+        # the last build of this instance, the glyphs to take from it and the
+        # glyphs to build, if only some glyphs changed since then
+        previousUFO, affected, required = None, None, None
+        if self.cache is not None:
+            with span("hashInputs", instance=names):
+                glyphDigests = hashInstanceGlyphs(mix, self.basefont)
+                components = self.instanceComponents(
+                    mix, names, italic, swapSuffixes, stemWidth, glyphDigests)
+            key, files = self.cache.lookup("instance", names, components)
+            if files is not None:
+                log(">> Restoring cached build")
+                with span("restoreCache", instance=names):
+                    self.cache.restore(
+                        "instance", key, files, self.outputDir())
+                ufoName = os.path.join(self.outputDir(), files["ufo"])
+                self.ufoKeys[ufoName] = key
+                if self.buildOTF and "otf" not in files:
+                    # entries of builds without OTFs only have the UFO
+                    log(">> Generating OTF file")
+                    otfName = self.compileOTF(OpenFont(ufoName), names)
+                    files = dict(files, otf=os.path.relpath(
+                        otfName, self.outputDir()))
+                    self.cache.store(
+                        "instance", names, key, components, self.outputDir(),
+                        files, data={"glyphs": glyphDigests})
+                return ufoName
+            reuse = self.reusableBuild(
+                mix, names, swapSuffixes, components, glyphDigests)
+            if reuse is not None:
+                previousUFO, affected, required = reuse
+                log(">> Rebuilding %d glyphs, reusing the others from the "
+                    "last build" % len(affected))
+                self.cache.annotate("rebuilt %d of %d glyphs" % (
+                    len(affected), len(glyphDigests)))
+
         log(">> Mixing masters")
-        if isinstance( mix, Mix):
-            f = mix.generateFont(self.basefont)
-        else:
-            f = mix.copy()
+        with span("mix", instance=names) as args:
+            if isinstance( mix, Mix):
+                # glyphs which aren't required are taken from the last build
+                f = mix.generateFont(self.basefont, required)
+            else:
+                f = mix.copy()
+            args["glyphs"] = len(f.keys())
         if italic == True:
             log(">> Italicizing")
             tweakAmmount = .085
@@ -100,88 +354,490 @@ class FontProject:
                 tweakAmmount = .05
             if names.find("Condensed") != -1:
                 narrowAmmount = .96
-            i = 0
-            for g in f:
-                i += 1
-                if i % 10 == 0: print g.name
+            with span("italicize", instance=names) as args:
+                glyphs = [g for g in f if g.name != "uniFFFD" and
+                          (required is None or g.name in required)]
+                args["glyphs"] = len(glyphs)
+                args["skipped"] = 0
+                for g in glyphs:
+                    if not removeGlyphOverlap(g, self.overlapCache):
+                        args["skipped"] += 1
+                contours = self.italicizeOnPool(glyphs, stemWidth)
 
-                if g.name == "uniFFFD":
-                    continue
+                i = 0
+                for g in glyphs:
+                    i += 1
+                    if i % 10 == 0: print g.name
 
-                removeGlyphOverlap(g)
-
-                if g.name in self.lessItalic:
-                    italicizeGlyph(f, g, 9, stemWidth=stemWidth)
-                elif False == (g.name in self.noItalic):
-                    italicizeGlyph(f, g, 10, stemWidth=stemWidth)
-                if g.width != 0:
-                    g.width += 10
+                    angle = self.italicAngle(g.name)
+                    if angle is not None:
+                        italicizeGlyph(f, g, angle, stemWidth=stemWidth,
+                                       contours=contours.get(g.name))
+                    if g.width != 0:
+                        g.width += 10
 
             # set the oblique flag in fsSelection
             f.info.openTypeOS2Selection.append(9)
 
         if swapSuffixes != None:
-            for swap in swapSuffixes:
-                swapList = [g.name for g in f if g.name.endswith(swap)]
-                for gname in swapList:
-                    print gname
-                    swapContours(f, gname.replace(swap,""), gname)
-        for gname in self.predecompose:
-            if f.has_key(gname):
-                decomposeGlyph(f, gname)
+            with span("swapContours", instance=names):
+                for swap in swapSuffixes:
+                    swapList = [g.name for g in f if g.name.endswith(swap)]
+                    for gname in swapList:
+                        print gname
+                        swapContours(f, gname.replace(swap,""), gname)
+        with span("decompose", instance=names):
+            for gname in self.predecompose:
+                if f.has_key(gname):
+                    decomposeGlyph(f, gname)
 
         log(">> Generating glyphs")
-        generateGlyphs(f, self.diacriticList, self.adobeGlyphList)
+        with span("generateGlyphs", instance=names) as args:
+            generateGlyphs(f, self.diacriticList, self.adobeGlyphList)
+            args["glyphs"] = len(f.keys())
         log(">> Copying features")
-        readFeatureFile(f, self.basefont.features.text)
+        with span("copyFeatures", instance=names):
+            readFeatureFile(f, self.basefont.features.text)
         log(">> Decomposing")
-        for gname in self.decompose:
-            if f.has_key(gname):
-                decomposeGlyph(f, gname)
+        with span("decompose", instance=names):
+            for gname in self.decompose:
+                if f.has_key(gname):
+                    decomposeGlyph(f, gname)
 
         setNamesRF(f, n, foundry=self.config.get('main', 'foundry'),
                          version=self.config.get('main', 'version'))
         if not self.compatible:
-            cleanCurves(f)
+            with span("removeOverlaps", instance=names) as args:
+                args["glyphs"], args["skipped"] = cleanCurves(
+                    f, required, self.overlapCache)
         deleteGlyphs(f, self.deleteList)
 
         log(">> Generating font files")
         ufoName = self.generateOutputPath(f, "ufo")
-        f.save(ufoName)
-        self.generatedFonts.append(ufoName)
+        outputs = [ufoName]
+        if self.cache is not None:
+            self.ufoKeys[ufoName] = key
+
+        def writeUFO():
+            with span("saveUFO", instance=names) as args:
+                f.save(ufoName)
+                if previousUFO is not None:
+                    copyGlyphFiles(
+                        previousUFO, ufoName,
+                        [gname for gname in f.keys() if gname not in affected])
+                args["glyphs"] = len(f.keys())
+
+        def storeOutputs():
+            files = dict(
+                (os.path.splitext(path)[1][1:],
+                 os.path.relpath(path, self.outputDir()))
+                for path in outputs)
+            self.cache.store(
+                "instance", names, key, components, self.outputDir(),
+                files, data={"glyphs": glyphDigests})
+
+        # glyphs reused from a previous build only exist in its UFO, so the
+        # font has to be saved and reopened in that case
+        handOff = self.inMemory and previousUFO is None
+        if handOff:
+            matchSavedFont(f)
+        else:
+            writeUFO()
 
         if self.buildOTF:
             log(">> Generating OTF file")
-            newFont = OpenFont(ufoName)
-            otfName = self.generateOutputPath(f, "otf")
-            saveOTF(
-                newFont, otfName,
-                self.thinGlyphOrder if "Thin" in otfName else self.glyphOrder)
+            outputs.append(self.compileOTF(
+                f if handOff else OpenFont(ufoName), names))
+
+        if handOff:
+            self.openFonts[ufoName] = f
+            if self.saveUFO:
+                self.saveThreads[ufoName] = BackgroundCall(writeUFO)
+                if self.cache is not None:
+                    self.pendingStores[ufoName] = storeOutputs
+        elif self.cache is not None:
+            storeOutputs()
+
+        return ufoName
+
+    def compileOTF(self, font, names):
+        """Compile an instance's OTF and return its path."""
+
+        otfName = self.generateOutputPath(font, "otf")
+        with self.trace.span("compileOTF", instance=names,
+                             glyphs=len(font.keys())):
+            saveOTF(font, otfName,
+                    self.thinGlyphOrder if "Thin" in otfName
+                    else self.glyphOrder)
+        return otfName
+
+    def italicAngle(self, glyphName):
+        """Return the angle to italicize a glyph by, or None to leave it."""
+
+        if glyphName in self.lessItalic:
+            return 9
+        if glyphName not in self.noItalic:
+            return 10
+        return None
+
+    def italicizeOnPool(self, glyphs, stemWidth):
+        """Italicize the contours of glyphs on italicWorkers processes.
+
+        Workers are sent and return contours packed into arrays rather than
+        RoboFab objects. Contours found in italicCache, if set, aren't
+        italicized again. Returns the italicized contours by glyph name, for
+        italicizeGlyph to write back, or nothing if there's a single worker
+        and neither italicBatch nor italicCache is set.
+        """
+
+        workers = self.italicWorkers
+        if multiprocessing.current_process().daemon:
+            workers = 1
+        cache = self.italicCache
+        if workers <= 1 and not self.italicBatch and cache is None:
+            return {}
+        tasks = [(packContours(g), g.name, self.italicAngle(g.name), stemWidth)
+                 for g in glyphs
+                 if len(g) > 0 and self.italicAngle(g.name) is not None]
+
+        contours = {}
+        if cache is not None:
+            keys = {}
+            pending = []
+            for task in tasks:
+                packed, glyphName, angle, unused = task
+                keys[glyphName] = cache.key(packed, angle, stemWidth)
+                found, result = cache.lookup(keys[glyphName])
+                if found:
+                    contours[glyphName] = result
+                else:
+                    pending.append(task)
+            tasks = pending
+        if not tasks:
+            return contours
+
+        if self.italicBatch:
+            italicized = self.italicizeBatches(tasks, workers)
+        elif workers > 1:
+            log("Italicizing %d glyphs with %d workers" % (
+                len(tasks), min(workers, len(tasks))))
+            italicized = dict(zip(
+                [task[1] for task in tasks],
+                self.runOnPool(_italicizeQueuedGlyph, tasks, workers)))
+        else:
+            italicized = dict(
+                (task[1], italicizeContours(*task)) for task in tasks)
+        if cache is not None:
+            for glyphName, result in italicized.items():
+                cache.store(keys[glyphName], result)
+        contours.update(italicized)
+        return contours
+
+    def italicizeBatches(self, tasks, workers):
+        """Italicize the glyphs of italicizeOnPool's tasks in batches.
+
+        Glyphs are batched by angle, and each angle's glyphs split between
+        the workers, for italicizeContourBatch to solve together.
+        """
+
+        byAngle = {}
+        for contours, glyphName, angle, stemWidth in tasks:
+            byAngle.setdefault((angle, stemWidth), []).append(
+                (contours, glyphName))
+        batches = []
+        for (angle, stemWidth), batch in sorted(byAngle.items()):
+            size = -(-len(batch) // workers)
+            for i in range(0, len(batch), size):
+                part = batch[i:i + size]
+                batches.append(([c for c, name in part],
+                                [name for c, name in part], angle, stemWidth))
+        log("Italicizing %d glyphs in %d batches" % (len(tasks), len(batches)))
+        if workers > 1 and len(batches) > 1:
+            results = self.runOnPool(_italicizeQueuedBatch, batches, workers)
+        else:
+            results = [italicizeContourBatch(*batch) for batch in batches]
+        italicized = {}
+        for batch, contours in zip(batches, results):
+            italicized.update(zip(batch[1], contours))
+        return italicized
+
+    def openGeneratedFont(self, ufoName):
+        """Return a generated font, straight from memory if it was handed off.
+        """
+
+        font = self.openFonts.pop(ufoName, None)
+        if font is None:
+            return OpenFont(ufoName)
+        # the font is about to be modified, so it must be saved as it is first
+        self.finishSaving(ufoName)
+        return font
+
+    def finishSaving(self, ufoName=None):
+        """Wait for a UFO (or all UFOs) being saved in the background."""
+
+        if ufoName is None:
+            names = self.saveThreads.keys()
+        else:
+            names = [ufoName]
+        for name in names:
+            if name in self.saveThreads:
+                self.saveThreads.pop(name).join()
+            if name in self.pendingStores:
+                self.pendingStores.pop(name)()
 
     def generateTTFs(self):
         """Build TTF for each font generated since last call to generateTTFs."""
 
-        fonts = [OpenFont(ufo) for ufo in self.generatedFonts]
+        self.runQueuedFonts()
+        ufoNames = self.generatedFonts
         self.generatedFonts = []
 
-        log(">> Converting curves to quadratic")
-        # using a slightly higher max error (e.g. 0.0025 em), dots will have
-        # fewer control points and look noticeably different
-        max_err = 0.002
+        # the TTFs depend on the UFOs, plus the other fonts of the batch if
+        # they are converted compatibly (which is all or nothing)
+        ttfCache = {}
+        if self.cache is not None and all(u in self.ufoKeys for u in ufoNames):
+            batch = [self.ufoKeys[u] for u in ufoNames if self.compatible]
+            for ufoName in ufoNames:
+                components = {
+                    "ufo": self.ufoKeys[ufoName],
+                    "conversion": hashData(self.compatible, batch)}
+                name = os.path.relpath(ufoName, self.outputDir())
+                key, files = self.cache.lookup("ttf", name, components)
+                ttfCache[ufoName] = (name, key, components, files)
+        toBuild = [u for u in ufoNames
+                   if u not in ttfCache or ttfCache[u][3] is None]
+        if self.compatible and toBuild:
+            toBuild = ufoNames
+        for ufoName in ufoNames:
+            if ufoName not in toBuild:
+                unused, key, unused, files = ttfCache[ufoName]
+                self.openFonts.pop(ufoName, None)
+                log(">> Restoring cached %s" % files["ttf"])
+                with self.trace.span("restoreCache", instance=files["ttf"]):
+                    self.cache.restore("ttf", key, files, self.outputDir())
+        if not toBuild:
+            return
+        tasks = [(ufoName, ttfCache.get(ufoName)) for ufoName in toBuild]
+
         if self.compatible:
-            fonts_to_quadratic(fonts, max_err_em=max_err, dump_stats=True, reverse_direction=True)
+            log(">> Converting curves to quadratic")
+            fonts = [self.openGeneratedFont(ufo) for ufo in toBuild]
+            with self.trace.span("cu2qu", fonts=len(fonts)):
+                fonts_to_quadratic(fonts, max_err_em=TTF_MAX_ERR, dump_stats=True, reverse_direction=True)
+            log(">> Generating TTF files")
+            for (ufoName, cacheEntry), font in zip(tasks, fonts):
+                self.compileTTF(font, cacheEntry)
+            return
+
+        # fonts are converted independently, so each one is opened, converted
+        # and compiled in turn, by as many workers as there are fonts in memory
+        workers = self.ttfWorkers or self.workers
+        log(">> Converting curves and generating TTF files")
+        if workers > 1 and len(tasks) > 1:
+            log("%d fonts with %d workers" % (
+                len(tasks), min(workers, len(tasks))))
+            self.runOnPool(_buildQueuedTTF, tasks, workers)
+            for ufoName in toBuild:
+                self.openFonts.pop(ufoName, None)
+        else:
+            for ufoName, cacheEntry in tasks:
+                self.buildTTF(ufoName, cacheEntry)
+
+    def buildTTF(self, ufoName, cacheEntry=None):
+        """Convert a generated font to quadratic curves and compile its TTF.
+        """
+
+        font = self.openGeneratedFont(ufoName)
+        instance = os.path.splitext(os.path.basename(ufoName))[0]
+        start = time.time()
+        with self.trace.span("cu2qu", glyphs=len(font.keys()),
+                             instance=instance):
+            fonts_to_quadratic([font], max_err_em=TTF_MAX_ERR, dump_stats=True, reverse_direction=True)
+        log("%s: converted to quadratic in %.1fs" % (
+            instance, time.time() - start))
+        self.compileTTF(font, cacheEntry)
+
+    def compileTTF(self, font, cacheEntry=None):
+        """Compile a font converted to quadratic curves, and cache the TTF.
+
+        cacheEntry is the name, key and components of the TTF in the cache,
+        if it is to be stored there.
+        """
+
+        ttfName = self.generateOutputPath(font, "ttf")
+        glyphOrder = (
+            self.thinGlyphOrder if "Thin" in ttfName else self.glyphOrder)
+        start = time.time()
+        with self.trace.span("compileTTF", glyphs=len(font.keys()),
+                             instance=os.path.basename(ttfName)):
+            saveOTF(font, ttfName, glyphOrder, truetype=True)
+        log("%s: compiled in %.1fs" % (
+            os.path.basename(ttfName), time.time() - start))
+        if cacheEntry is not None:
+            name, key, components, unused = cacheEntry
+            self.cache.store(
+                "ttf", name, key, components, self.outputDir(),
+                {"ttf": os.path.relpath(ttfName, self.outputDir())})
+
+    def generateVariableFont(self, styles):
+        """Build a variable TTF with a weight axis from some styles.
+
+        styles lists (mix, names, weight) for each style, like the arguments
+        of generateFont. Every style is a master of the variable font and one
+        of its named instances, so that these match the static fonts, except
+        that they keep their overlaps; the style at weight 400 is the default.
+        """
+
+        masters = []
+        for mix, names, weight in styles:
+            log(">> Building %s as a variable font master" % names)
+            with self.trace.span("variableMaster", instance=names) as args:
+                masters.append(self.buildVariableMaster(mix, names))
+                args["glyphs"] = len(masters[-1].keys())
+
+        log(">> Converting curves to quadratic")
+        with self.trace.span("cu2qu", fonts=len(masters)):
+            fonts_to_quadratic(masters, max_err_em=TTF_MAX_ERR,
+                               reverse_direction=True)
+
+        default = masters[[w for m, n, w in styles].index(400)]
+        family = default.info.familyName.replace(" ", "")
+        tempDir = tempfile.mkdtemp()
+        try:
+            sources = []
+            for i, (f, (mix, names, weight)) in enumerate(zip(masters, styles)):
+                ttfName = os.path.join(tempDir, "master%d.ttf" % i)
+                with self.trace.span("compileTTF", glyphs=len(f.keys()),
+                                     instance=names):
+                    saveOTF(f, ttfName, self.glyphOrder, truetype=True)
+                sources.append((ttfName, f.info.styleName,
+                                f.info.postscriptFontName, weight))
+            designspace = os.path.join(tempDir, family + ".designspace")
+            writeDesignspace(designspace, sources)
+
+            log(">> Generating variable font")
+            with self.trace.span("varLib", fonts=len(masters)):
+                vf, unused, unused = varLib.build(designspace)
+            path = os.path.join(self.outputDir(), family + "VF")
+            if not os.path.exists(path):
+                os.makedirs(path)
+            vfName = os.path.join(path, "%s-VF.ttf" % family)
+            vf.save(vfName)
+        finally:
+            shutil.rmtree(tempDir)
+        return vfName
+
+    def buildVariableMaster(self, mix, names):
+        """Generate a style like generateFont, but keeping it compatible
+        with the other masters: without overlap removal, and upright."""
+
+        if isinstance(mix, Mix):
+            f = mix.generateFont(self.basefont)
         else:
-            for font in fonts:
-                fonts_to_quadratic([font], max_err_em=max_err, dump_stats=True, reverse_direction=True)
+            f = mix.copy()
+        for gname in self.predecompose:
+            if f.has_key(gname):
+                decomposeGlyph(f, gname)
+        generateGlyphs(f, self.diacriticList, self.adobeGlyphList)
+        readFeatureFile(f, self.basefont.features.text)
+        for gname in self.decompose:
+            if f.has_key(gname):
+                decomposeGlyph(f, gname)
+        setNamesRF(f, names.split("/"),
+                   foundry=self.config.get('main', 'foundry'),
+                   version=self.config.get('main', 'version'))
+        deleteGlyphs(f, self.deleteList)
+        return f
+
+    def report(self):
+        """Log a summary of the build, to be called once it is done."""
+
+        self.finishSaving()
+        for cache in (self.overlapCache, self.italicCache):
+            if cache is not None:
+                cache.save()
+        caches = [c for c in (self.cache, self.overlapCache, self.italicCache,
+                              self.masterSnapshots) if c is not None]
+        if caches:
+            log(">> Build cache")
+        for cache in caches:
+            for line in cache.report():
+                log(line)
+
+        log(">> Build stages")
+        for line in self.trace.summary():
+            log(line)
+
+        log(">> Glyphs without overlaps")
+        for event in self.trace.events:
+            if "skipped" in event["args"]:
+                log("%s (%s): %d of %d" % (
+                    event["args"]["instance"], event["name"],
+                    event["args"]["skipped"], event["args"]["glyphs"]))
+        if self.traceFile is not None:
+            self.trace.save(self.traceFile)
+            log("Trace written to %s" % self.traceFile)
+
+
+# using a slightly higher max error (e.g. 0.0025 em), dots will have fewer
+# control points and look noticeably different
+TTF_MAX_ERR = 0.002
+
+
+# project and tasks being run by a worker pool; workers inherit them when they
+# are forked, so they never have to be pickled
+_poolProject = None
+_poolTasks = None
+
+
+def _runPoolTask(index):
+    """Worker entry point, runs one of the tasks of _poolProject."""
+
+    project = _poolProject
+    function, tasks = _poolTasks
+    # drop anything inherited from the parent or left by the previous task
+    project.takeWorkerState()
+    result = function(project, *tasks[index])
+    return result, project.takeWorkerState()
+
+
+def _buildQueuedFont(project, *args):
+    # fonts can't be handed back to the parent other than through their UFOs
+    project.inMemory = False
+    return project.buildFont(*args)
 
-        log(">> Generating TTF files")
-        for font in fonts:
-            ttfName = self.generateOutputPath(font, "ttf")
-            log(os.path.basename(ttfName))
-            saveOTF(
-                font, ttfName,
-                self.thinGlyphOrder if "Thin" in ttfName else self.glyphOrder,
-                truetype=True)
+
+def _buildQueuedTTF(project, ufoName, cacheEntry):
+    project.buildTTF(ufoName, cacheEntry)
+
+
+def _italicizeQueuedGlyph(project, contours, glyphName, angle, stemWidth):
+    return italicizeContours(contours, glyphName, angle, stemWidth)
+
+
+def _italicizeQueuedBatch(project, contours, glyphNames, angle, stemWidth):
+    return italicizeContourBatch(contours, glyphNames, angle, stemWidth)
+
+
+class BackgroundCall(threading.Thread):
+    """Runs a function in a thread, and reraises its errors when joined."""
+
+    def __init__(self, function):
+        threading.Thread.__init__(self)
+        self.function = function
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.function()
+        except:
+            self.error = sys.exc_info()
+
+    def join(self):
+        threading.Thread.join(self)
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
 
 
 def transformGlyphMembers(g, m):
@@ -227,6 +883,40 @@ def swapContours(f,gName1,gName2):
     g2.width = g3.width
 
 
+def copyGlyphFiles(srcUFO, dstUFO, glyphNames):
+    """Copy the .glif files of some glyphs from one UFO to another."""
+
+    src = GlyphSet(os.path.join(srcUFO, "glyphs"))
+    dst = GlyphSet(os.path.join(dstUFO, "glyphs"))
+    for gname in glyphNames:
+        shutil.copyfile(os.path.join(src.dirName, src.contents[gname]),
+                        os.path.join(dst.dirName, dst.contents[gname]))
+
+
+def matchSavedFont(f):
+    """Make a font look the way it would after being saved and reopened.
+
+    The .glif writer formats numbers with str(), which keeps 12 significant
+    digits of Python floats (but all digits of numpy floats), and glyphs
+    copied from other fonts still measure their components in those fonts.
+    Fonts compiled straight from memory must match both to come out identical
+    to fonts compiled from their UFOs.
+    """
+
+    roundTrip = lambda v: v if isinstance(v, int) else type(v)(str(v))
+    for g in f:
+        g.setParent(f)
+        g.width = roundTrip(g.width)
+        for c in g:
+            for p in c.points:
+                p.x, p.y = roundTrip(p.x), roundTrip(p.y)
+        for c in g.components:
+            c.offset = tuple(roundTrip(v) for v in c.offset)
+            c.scale = tuple(roundTrip(v) for v in c.scale)
+        for a in g.anchors:
+            a.x, a.y = roundTrip(a.x), roundTrip(a.y)
+
+
 def log(msg):
     print msg
 
@@ -238,10 +928,21 @@ def generateGlyphs(f, glyphNames, glyphList={}):
     for glyphName in glyphNames:
         generateGlyph(f, glyphName, glyphList)
 
-def cleanCurves(f):
+def cleanCurves(f, glyphNames=None, cache=None):
+    """Remove overlaps from the given glyphs, or from all glyphs.
+
+    Returns how many glyphs were processed, and how many of them were found
+    to have no overlaps and skipped.
+    """
+
     log(">> Removing overlaps")
+    processed = skipped = 0
     for g in f:
-        removeGlyphOverlap(g)
+        if glyphNames is None or g.name in glyphNames:
+            processed += 1
+            if not removeGlyphOverlap(g, cache):
+                skipped += 1
+    log("%d of %d glyphs had no overlaps" % (skipped, processed))
 
     # log(">> Mitring sharp corners")
     # for g in f:
@@ -251,6 +952,8 @@ def cleanCurves(f):
     # for g in f:
     #     glyphCurvesToQuadratic(g)
 
+    return processed, skipped
+
 
 def deleteGlyphs(f, deleteList):
     for name in deleteList:
@@ -258,13 +961,92 @@ def deleteGlyphs(f, deleteList):
             f.removeGlyph(name)
 
 
-def removeGlyphOverlap(glyph):
-    """Remove overlaps in contours from a glyph."""
-    #TODO(jamesgk) verify overlaps exist first, as per library's recommendation
-    manager = BooleanOperationManager()
-    contours = glyph.contours
-    glyph.clearContours()
-    manager.union(contours, glyph.getPointPen())
+def removeGlyphOverlap(glyph, cache=None):
+    """Remove overlaps in contours from a glyph.
+
+    Returns False if the glyph had no overlaps, and was left as it is. The
+    result is looked up in and added to an OverlapCache, if given.
+    """
+
+    if cache is not None:
+        pen = ContourRecorder()
+        for contour in glyph:
+            contour.drawPoints(pen)
+        key = cache.key(pen.contours)
+        found, result = cache.lookup(key)
+        if found:
+            if result is not None:
+                glyph.clearContours()
+                replayContours(result, glyph.getPointPen())
+            return result is not None
+
+    result = None
+    if hasOverlaps(glyph):
+        pen = ContourRecorder()
+        BooleanOperationManager().union(glyph.contours, pen)
+        result = pen.contours
+        glyph.clearContours()
+        replayContours(result, glyph.getPointPen())
+    if cache is not None:
+        cache.store(key, result)
+    return result is not None
+
+
+class ContourRecorder:
+    """Point pen recording contours as lists of addPoint arguments."""
+
+    def __init__(self):
+        self.contours = []
+
+    def beginPath(self):
+        self.contours.append([])
+
+    def addPoint(self, pt, segmentType=None, smooth=False, name=None,
+                 **kwargs):
+        self.contours[-1].append((pt, segmentType, smooth, name, kwargs))
+
+    def endPath(self):
+        pass
+
+
+def replayContours(contours, pointPen):
+    for contour in contours:
+        pointPen.beginPath()
+        for pt, segmentType, smooth, name, kwargs in contour:
+            pointPen.addPoint(pt, segmentType, smooth, name, **kwargs)
+        pointPen.endPath()
+
+
+def writeDesignspace(path, sources):
+    """Write a designspace for varLib with a weight axis.
+
+    sources lists (TTF path, style name, PostScript name, weight) for each
+    master, which is also a named instance. The master at weight 400 is the
+    default.
+    """
+
+    weights = [source[3] for source in sources]
+    root = ElementTree.Element("designspace", format="3")
+    axes = ElementTree.SubElement(root, "axes")
+    ElementTree.SubElement(axes, "axis", {
+        "tag": "wght", "name": "weight", "minimum": str(min(weights)),
+        "default": "400", "maximum": str(max(weights))})
+    sourcesElement = ElementTree.SubElement(root, "sources")
+    instances = ElementTree.SubElement(root, "instances")
+    for ttfName, styleName, psName, weight in sources:
+        source = ElementTree.SubElement(
+            sourcesElement, "source", filename=os.path.basename(ttfName),
+            name=styleName)
+        location = ElementTree.SubElement(source, "location")
+        ElementTree.SubElement(
+            location, "dimension", name="weight", xvalue=str(weight))
+        instance = ElementTree.SubElement(
+            instances, "instance", stylename=styleName,
+            postscriptfontname=psName)
+        location = ElementTree.SubElement(instance, "location")
+        ElementTree.SubElement(
+            location, "dimension", name="weight", xvalue=str(weight))
+    ElementTree.ElementTree(root).write(path)
 
 
 def saveOTF(font, destFile, glyphOrder, truetype=False):
@@ -85,7 +85,7 @@ def subsegmentIndex(contourIndex, segmentIndex, subsegments):
 
 
 def alignPoints(pts, start=None, end=None):
-    if start == None or end == None:
+    if start is None or end is None:
         start, end = fitLine(pts)
     out = pts.copy()
     for i,p in enumerate(pts):
@@ -0,0 +1,585 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Content-addressed cache of build outputs.
+
+Every cached stage is described by a dict of named components (master data,
+mix factor, arguments, config...), each one a string digest. The cache key is
+the hash of all components; the components themselves are kept next to the
+outputs so that a miss can be explained by the components which changed since
+the last build of the same target.
+"""
+
+
+import errno
+import glob
+import cPickle as pickle
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pkg_resources
+from robofab.ufoLib import fontInfoAttributesVersion2
+
+from fontbuild.mix import FFont, FGlyph, GlyphStructure, Mix
+
+
+MANIFEST = "manifest.json"
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class BuildCache:
+    """Stores build outputs under a key hashed from everything they depend on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+
+    def lookup(self, stage, name, components):
+        """Return the key for a target and its cached files, if any.
+
+        The returned files are None on a miss, in which case the reasons for
+        the miss are recorded along with it for the build report.
+        """
+
+        key = hashComponents(components)
+        manifest = self._readJSON(os.path.join(
+            self.path, stage, key, MANIFEST))
+        if manifest is not None:
+            self.events.append((stage, name, True, []))
+            return key, manifest["files"]
+
+        previous = self._readJSON(self._latestPath(stage, name))
+        if previous is None:
+            reasons = ["no previous build"]
+        else:
+            reasons = sorted(
+                c for c in set(components) | set(previous)
+                if components.get(c) != previous.get(c))
+            if not reasons:
+                reasons = ["cache entry missing"]
+        self.events.append((stage, name, False, reasons))
+        return key, None
+
+    def previous(self, stage, name):
+        """Return the key and manifest of the last build of a target.
+
+        Returns None if the target was never built or its entry is gone.
+        """
+
+        components = self._readJSON(self._latestPath(stage, name))
+        if components is None:
+            return None
+        key = hashComponents(components)
+        manifest = self._readJSON(self.entryPath(stage, key, MANIFEST))
+        if manifest is None:
+            return None
+        return key, manifest
+
+    def entryPath(self, stage, key, relPath):
+        return os.path.join(self.path, stage, key, relPath)
+
+    def annotate(self, note):
+        """Add a note to the report line of the last lookup."""
+
+        self.events[-1][3].append(note)
+
+    def restore(self, stage, key, files, destDir):
+        """Copy the cached files of a target back into destDir."""
+
+        entry = os.path.join(self.path, stage, key)
+        for relPath in files.values():
+            copyPath(os.path.join(entry, relPath),
+                     os.path.join(destDir, relPath))
+
+    def store(self, stage, name, key, components, srcDir, files, data=None):
+        """Copy a target's freshly built files from srcDir into the cache.
+
+        files maps output kinds (e.g. "ufo", "otf") to paths relative to
+        srcDir, and is returned as-is by later lookups of the same key. Any
+        extra data is saved in the manifest for the next build to use.
+        """
+
+        stageDir = os.path.join(self.path, stage)
+        makeDirs(stageDir)
+        entry = os.path.join(stageDir, key)
+        manifest = self._readJSON(os.path.join(entry, MANIFEST))
+        if manifest is not None and manifest["files"] != files:
+            # an entry missing some of the outputs, to be replaced
+            staleDir = tempfile.mkdtemp(dir=stageDir)
+            try:
+                os.rename(entry, os.path.join(staleDir, key))
+            except OSError:
+                pass
+            shutil.rmtree(staleDir, ignore_errors=True)
+        if not os.path.exists(entry):
+            # fill a temporary directory first, so that a concurrent or
+            # interrupted build never sees a partial entry
+            tempDir = tempfile.mkdtemp(dir=stageDir)
+            for relPath in files.values():
+                copyPath(os.path.join(srcDir, relPath),
+                         os.path.join(tempDir, relPath))
+            self._writeJSON(os.path.join(tempDir, MANIFEST),
+                            {"name": name, "files": files,
+                             "components": components, "data": data})
+            try:
+                os.rename(tempDir, entry)
+            except OSError:
+                shutil.rmtree(tempDir)
+                if not os.path.exists(entry):
+                    raise
+        makeDirs(os.path.dirname(self._latestPath(stage, name)))
+        self._writeJSON(self._latestPath(stage, name), components)
+
+    def report(self):
+        """Return lines summarizing hits and misses, with reasons for misses.
+        """
+
+        lines = []
+        for stage in sorted(set(e[0] for e in self.events)):
+            events = [e for e in self.events if e[0] == stage]
+            hits = len([e for e in events if e[2]])
+            lines.append("%s: %d hits, %d misses" % (
+                stage, hits, len(events) - hits))
+            for unused, name, hit, reasons in events:
+                if not hit:
+                    lines.append("  %s: %s" % (name, ", ".join(reasons)))
+        return lines
+
+    def _latestPath(self, stage, name):
+        return os.path.join(
+            self.path, stage, "latest",
+            name.replace("/", "_").replace(" ", "") + ".json")
+
+    def _readJSON(self, path):
+        try:
+            with open(path) as jsonFile:
+                return json.load(jsonFile)
+        except (IOError, ValueError):
+            return None
+
+    def _writeJSON(self, path, data):
+        with open(path, "w") as jsonFile:
+            json.dump(data, jsonFile, indent=2, sort_keys=True)
+
+
+class MemoCache:
+    """Results of a pure function of glyph outlines, kept in a pickle file.
+
+    Results are loaded from and added to a file named after the hash of the
+    code they depend on, which keeps their numbers' types (these change how
+    the UFOs are written). Subclasses set name and define key.
+    """
+
+    name = None
+
+    def __init__(self, path, codeHash):
+        self.path = os.path.join(path, codeHash + ".pickle")
+        self.entries = self._load()
+        self.added = {}
+        self.hits = self.misses = 0
+
+    def lookup(self, key):
+        """Return whether a result was found, and the result."""
+
+        if key in self.entries:
+            self.hits += 1
+            return True, self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key, result):
+        self.entries[key] = self.added[key] = result
+
+    def takeState(self):
+        """Return and reset what was added and counted since the last call."""
+
+        state = self.added, self.hits, self.misses
+        self.added = {}
+        self.hits = self.misses = 0
+        return state
+
+    def mergeState(self, state):
+        added, hits, misses = state
+        self.entries.update(added)
+        self.added.update(added)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self):
+        """Add new results to the file, along with any other build's."""
+
+        if not self.added:
+            return
+        entries = self._load()
+        entries.update(self.added)
+        makeDirs(os.path.dirname(self.path))
+        handle, tempPath = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(handle, "wb") as pickleFile:
+            pickle.dump(entries, pickleFile, pickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, self.path)
+        self.entries = entries
+        self.added = {}
+
+    def report(self):
+        lookups = self.hits + self.misses
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return ["%s: %d hits, %d misses (%.0f%% hit rate), %d entries, "
+                "%.1f MB" % (self.name, self.hits, self.misses,
+                             100.0 * self.hits / lookups if lookups else 0,
+                             len(self.entries), size / 1e6)]
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as pickleFile:
+                return pickle.load(pickleFile)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+
+
+class OverlapCache(MemoCache):
+    """Results of overlap removal, keyed by the contours they came from.
+
+    Many glyphs reach the union with the same outlines in every instance and
+    every build. A result of None means the contours had no overlaps.
+    """
+
+    name = "overlaps"
+
+    def __init__(self, path):
+        MemoCache.__init__(self, path, hashOverlapCode())
+
+    def key(self, contours):
+        """Return the key of contours recorded as (pt, type, smooth, name)."""
+
+        return hashData([
+            [(pt, [type(v).__name__ for v in pt], segmentType, smooth, name)
+             for pt, segmentType, smooth, name, unused in contour]
+            for contour in contours])
+
+
+class ItalicCache(MemoCache):
+    """Italicized contours, keyed by the contours and italic parameters they
+    came from.
+
+    Glyphs which aren't mixed, or whose masters didn't change, reach the
+    italic stage with the same outlines in every build, so they needn't be
+    segmented, solved and refitted again. Contours are packed by
+    packContours.
+    """
+
+    name = "italics"
+
+    def __init__(self, path):
+        MemoCache.__init__(self, path, hashItalicCode())
+
+    def key(self, contours, angle, stemWidth):
+        coordinates, pointTypes, segments = contours
+        return hashData(
+            coordinates.tolist(), pointTypes, segments, angle, stemWidth)
+
+
+class MasterSnapshots:
+    """Decomposed master data, keyed by the UFOs they were read from.
+
+    Each snapshot is a directory with the master's values in an .npy file,
+    laid out like FFont.pack so that the loaded glyphs' data are views of the
+    memory-mapped array, and the glyph structure, kerning and stems in a
+    pickle. Only the latest snapshot of each UFO is kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = []
+        self.saved = []
+
+    def key(self, path, overlayPath=None):
+        """Return the UFO's name and the hash of its (and the overlay's) files.
+        """
+
+        files = []
+        for ufoPath in (path, overlayPath):
+            if ufoPath is None:
+                continue
+            for root, dirs, names in os.walk(ufoPath):
+                dirs.sort()
+                files.extend(os.path.join(root, n) for n in sorted(names))
+        name = os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+        return "%s-%s" % (name, hashData(
+            [os.path.relpath(f, path) for f in files], hashFiles(files),
+            hashSnapshotCode()))
+
+    def load(self, key):
+        """Return the FFont saved under key, or None."""
+
+        snapshotPath = self._snapshotPath(key)
+        try:
+            with open(os.path.join(snapshotPath, "font.pickle"),
+                      "rb") as pickleFile:
+                glyphs, hstems, vstems, kerning = pickle.load(pickleFile)
+            # copy-on-write, so that changing the master doesn't change the file
+            data = np.load(os.path.join(snapshotPath, "data.npy"),
+                           mmap_mode="c")
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+        ffont = FFont()
+        names = []
+        starts = {}
+        for name, start, end, width, contours, components, anchors in glyphs:
+            ffont.glyphs[name] = FGlyph.fromStructure(
+                GlyphStructure(name, width, contours, components, anchors),
+                data[start:end, 0], data[start + 1:end, 1])
+            names.append(name)
+            starts[name] = start
+        ffont.hstems = hstems
+        ffont.vstems = vstems
+        ffont.kerning = kerning
+        ffont.packed = names, data, starts
+        ffont.packedGlyphs = [(n, ffont.glyphs[n]) for n in names]
+        self.loaded.append(key)
+        return ffont
+
+    def save(self, key, ffont):
+        """Save an FFont under key, replacing older snapshots of its UFO."""
+
+        names, data, starts = ffont.pack()
+        glyphs = []
+        for name in names:
+            g = ffont.glyphs[name]
+            glyphs.append((name, starts[name], starts[name] + len(g.dataX),
+                           g.width, g.contours, g.components, g.anchors))
+
+        makeDirs(self.path)
+        tempPath = tempfile.mkdtemp(dir=self.path)
+        np.save(os.path.join(tempPath, "data.npy"), data)
+        with open(os.path.join(tempPath, "font.pickle"), "wb") as pickleFile:
+            pickle.dump((glyphs, ffont.hstems, ffont.vstems, ffont.kerning),
+                        pickleFile, pickle.HIGHEST_PROTOCOL)
+
+        name = key.rsplit("-", 1)[0]
+        for oldKey in os.listdir(self.path):
+            if oldKey.rsplit("-", 1)[0] == name:
+                shutil.rmtree(self._snapshotPath(oldKey), ignore_errors=True)
+        try:
+            os.rename(tempPath, self._snapshotPath(key))
+        except OSError:
+            # saved by another build in the meantime
+            shutil.rmtree(tempPath, ignore_errors=True)
+        self.saved.append(key)
+
+    def report(self):
+        return ["masters: %d loaded from snapshots, %d saved" % (
+            len(self.loaded), len(self.saved))]
+
+    def _snapshotPath(self, key):
+        return os.path.join(self.path, key)
+
+
+def makeDirs(path):
+    """Create a directory, tolerating other processes creating it too."""
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def copyPath(src, dst):
+    """Copy a file or directory (e.g. a UFO), replacing anything at dst."""
+
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    makeDirs(os.path.dirname(dst))
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def hashComponents(components):
+    return hashlib.sha1(json.dumps(components, sort_keys=True)).hexdigest()
+
+
+def hashData(*data):
+    """Hash JSON-serializable data, using repr for anything else."""
+
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=repr)).hexdigest()
+
+
+def hashFiles(paths):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def hashCode():
+    """Hash the fontbuild sources and the versions of the libraries they use.
+    """
+
+    return hashData(
+        hashFiles(sorted(glob.glob(os.path.join(SOURCE_DIR, "*.py")))),
+        libraryVersions("booleanOperations", "cu2qu", "fonttools", "robofab",
+                        "ufo2ft"))
+
+
+def hashOverlapCode():
+    """Hash the code which overlap removal results depend on."""
+
+    return hashData(
+        hashFiles([os.path.join(SOURCE_DIR, "overlaps.py")]),
+        libraryVersions("booleanOperations", "pyclipper"))
+
+
+def hashItalicCode():
+    """Hash the code which italicized contours depend on."""
+
+    return hashData(
+        hashFiles([os.path.join(SOURCE_DIR, name)
+                   for name in ("italics.py", "curveFitPen.py",
+                                "alignpoints.py")]),
+        libraryVersions("fonttools", "numpy", "robofab", "scipy"))
+
+
+def hashSnapshotCode():
+    """Hash the code which reads masters into FFonts."""
+
+    return hashData(
+        hashFiles([os.path.join(SOURCE_DIR, name)
+                   for name in ("mix.py", "kerning.py",
+                                "decomposeGlyph.py")]),
+        libraryVersions("numpy", "robofab"))
+
+
+def libraryVersions(*names):
+    versions = []
+    for name in names:
+        try:
+            version = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            version = ""
+        versions.append("%s %s" % (name, version))
+    return versions
+
+
+def hashGlyph(glyph):
+    """Hash a RoboFab glyph's outlines, metrics and metadata."""
+
+    return hashData(
+        glyph.name, glyph.width, glyph.unicodes, glyph.note, glyph.lib,
+        [[(s.type, s.smooth, [(p.x, p.y, p.name) for p in s.points])
+          for s in contour.segments] for contour in glyph],
+        [(c.baseGlyph, c.offset, c.scale) for c in glyph.components],
+        [(a.name, a.x, a.y) for a in glyph.anchors])
+
+
+def hashGlyphs(font):
+    """Hash each glyph of a RoboFab font, by name."""
+
+    return dict((g.name, hashGlyph(g)) for g in font)
+
+
+def hashFontData(font):
+    """Hash the font-level data of a RoboFab font, i.e. all but the glyphs."""
+
+    return hashData(
+        dict((attr, getattr(font.info, attr, None))
+             for attr in fontInfoAttributesVersion2),
+        sorted(font.kerning.asDict().items()), font.groups,
+        font.features.text, font.lib)
+
+
+def hashFGlyph(glyph):
+    return hashData(
+        glyph.name, glyph.width, glyph.contours, glyph.components,
+        glyph.anchors, hashlib.sha1(glyph.dataX.tostring()).hexdigest(),
+        hashlib.sha1(glyph.dataY.tostring()).hexdigest())
+
+
+def hashFGlyphs(ffont):
+    return dict((name, hashFGlyph(g)) for name, g in ffont.glyphs.iteritems())
+
+
+def hashFFontData(ffont):
+    return hashData(ffont.hstems, ffont.vstems, sorted(ffont.kerning.items()))
+
+
+# digests of masters and base fonts, which are hashed once for every instance
+# built from them; sources are kept alongside so that their ids stay unique
+_digestMemo = {}
+
+
+def memoHash(obj, hashFunc):
+    """Hash an object which is not modified during the build only once."""
+
+    key = id(obj), hashFunc.__name__
+    if key not in _digestMemo:
+        _digestMemo[key] = (obj, hashFunc(obj))
+    return _digestMemo[key][1]
+
+
+def hashMasterGlyphs(master):
+    if master.mix is not None:
+        # glyphs of nested mixes are not tracked individually
+        digest = hashMix(master.mix)
+        return dict((name, digest) for name in master.mix.keys())
+    return memoHash(master.ffont, hashFGlyphs)
+
+
+def hashMasterData(master):
+    if master.mix is not None:
+        return hashMix(master.mix)
+    return memoHash(master.ffont, hashFFontData)
+
+
+def hashMix(mix):
+    """Hash the master data and mix factor of a Mix."""
+
+    return hashData(
+        [sorted(hashMasterGlyphs(m).items()) for m in mix.masters],
+        [hashMasterData(m) for m in mix.masters], *mixFactors(mix))
+
+
+def mixFactors(mix):
+    """Return what a Mix depends on besides its masters' data."""
+
+    if mix.space is None:
+        return [mix.v.x, mix.v.y]
+    return [mix.space.locations, sorted(
+        (axis, getattr(v, "x", v), getattr(v, "y", v))
+        for axis, v in mix.location.items())]
+
+
+def hashInstanceGlyphs(mix, basefont):
+    """Hash the inputs of every glyph of an instance, by glyph name.
+
+    mix is either a Mix of masters, which is applied to the glyphs of
+    basefont, or a font used as-is, like in FontProject.generateFont.
+    """
+
+    if not isinstance(mix, Mix):
+        return memoHash(mix, hashGlyphs)
+    masterGlyphs = [hashMasterGlyphs(m) for m in mix.masters]
+    return dict(
+        (name, hashData(digest, [glyphs.get(name) for glyphs in masterGlyphs]))
+        for name, digest in memoHash(basefont, hashGlyphs).iteritems())
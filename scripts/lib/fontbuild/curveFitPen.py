@@ -15,7 +15,8 @@
 # limitations under the License.
 
 
-__all__ = ["SubsegmentPen","SubsegmentsToCurvesPen", "segmentGlyph", "fitGlyph"]
+__all__ = ["SubsegmentPen","SubsegmentsToCurvesPen", "segmentGlyph",
+           "segmentContours", "fitGlyph", "fitContours", "fitGlyphs"]
 
 
 from fontTools.pens.basePen import BasePen
@@ -27,13 +28,10 @@ from robofab.pens.pointPen import BasePointToSegmentPen
 
 
 class SubsegmentsToCurvesPointPen(BasePointToSegmentPen):
-    def __init__(self, glyph, subsegmentGlyph, subsegments):
+    def __init__(self, glyph, contourPoints, subsegments):
         BasePointToSegmentPen.__init__(self)
         self.glyph = glyph
-        self.subPen = SubsegmentsToCurvesPen(None, glyph.getPen(), subsegmentGlyph, subsegments)
-
-    def setMatchTangents(self, b):
-        self.subPen.matchTangents = b
+        self.subPen = SubsegmentsToCurvesPen(None, glyph.getPen(), contourPoints, subsegments)
 
     def _flushContour(self, segments):
         #
@@ -85,16 +83,30 @@ class SubsegmentsToCurvesPointPen(BasePointToSegmentPen):
 
 
 class SubsegmentsToCurvesPen(BasePen):
-    def __init__(self, glyphSet, otherPen, subsegmentGlyph, subsegments):
+    """Draws curves fitted to the subsegment points of every contour, given
+    as an (n, 2) array per contour.
+
+    The curves aren't fitted as they are drawn: the pen records what it
+    draws and the points of every curve, so that the curves of many pens
+    can be fitted together by fitCurves. Drawing into otherPen is left to
+    replay.
+    """
+
+    def __init__(self, glyphSet, otherPen, contourPoints, subsegments):
         BasePen.__init__(self, None)
         self.otherPen = otherPen
-        self.ssglyph = subsegmentGlyph
+        self.contourPoints = contourPoints
         self.subsegments = subsegments
         self.contourIndex = -1
         self.segmentIndex = -1
         self.lastPoint = (0,0)
         self.lastSmooth = False
         self.nextSmooth = False
+        # calls to make to otherPen, with the indices of curves in place of
+        # their points, and the curves as (points, previous point, next
+        # point, smooth start, smooth end)
+        self.calls = []
+        self.curves = []
 
     def setLastSmooth(self, b):
         self.lastSmooth = b
@@ -103,15 +115,15 @@ class SubsegmentsToCurvesPen(BasePen):
         self.contourIndex += 1
         self.segmentIndex = 0
         self.startPoint = (x,y)
-        p = self.ssglyph.contours[self.contourIndex][0].points[0]
-        self.otherPen.moveTo((p.x, p.y))
+        p = self.contourPoints[self.contourIndex][0]
+        self.calls.append(("moveTo", tuple(p.tolist())))
         self.lastPoint = (x,y)
 
     def _lineTo(self, (x, y)):
         self.segmentIndex += 1
         index = self.subsegments[self.contourIndex][self.segmentIndex][0]
-        p = self.ssglyph.contours[self.contourIndex][index].points[0]
-        self.otherPen.lineTo((p.x, p.y))
+        p = self.contourPoints[self.contourIndex][index]
+        self.calls.append(("lineTo", tuple(p.tolist())))
         self.lastPoint = (x,y)
         self.lastSmooth = False
 
@@ -127,58 +139,42 @@ class SubsegmentsToCurvesPen(BasePen):
 
     def _curveToOne(self, (x1, y1), (x2, y2), (x3, y3)):
         self.segmentIndex += 1
-        c = self.ssglyph.contours[self.contourIndex]
+        c = self.contourPoints[self.contourIndex]
         n = len(c)
         startIndex = (self.subsegments[self.contourIndex][self.segmentIndex-1][0])
         segmentCount = (self.subsegments[self.contourIndex][self.segmentIndex][1])
         endIndex = (startIndex + segmentCount + 1) % (n)
 
         indices = [(startIndex + i) % (n) for i in range(segmentCount + 1)]
-        points = np.array([(c[i].points[0].x, c[i].points[0].y) for i in indices])
-        prevPoint = (c[(startIndex - 1)].points[0].x, c[(startIndex - 1)].points[0].y)
-        nextPoint = (c[(endIndex) % n].points[0].x, c[(endIndex) % n].points[0].y)
-        prevTangent = prevPoint - points[0]
-        nextTangent = nextPoint - points[-1]
-
-        tangent1 = points[1] - points[0]
-        tangent3 = points[-2] - points[-1]
-        prevTangent /= np.linalg.norm(prevTangent)
-        nextTangent /= np.linalg.norm(nextTangent)
-        tangent1 /= np.linalg.norm(tangent1)
-        tangent3 /= np.linalg.norm(tangent3)
-
-        tangent1, junk = self.smoothTangents(tangent1, prevTangent, self.lastSmooth)
-        tangent3, junk = self.smoothTangents(tangent3, nextTangent, self.nextSmooth)
-        if self.matchTangents == True:
-            cp = fitBezier(points, tangent1, tangent3)
-            cp[1] = norm(cp[1] - cp[0]) * tangent1 / norm(tangent1) + cp[0]
-            cp[2] = norm(cp[2] - cp[3]) * tangent3 / norm(tangent3) + cp[3]
-        else:
-            cp = fitBezier(points)
-        # if self.ssglyph.name == 'r':
-        #     print "-----------"
-        #     print self.lastSmooth, self.nextSmooth
-        #     print "%i %i : %i %i \n %i %i : %i %i \n %i %i : %i %i"%(x1,y1, cp[1,0], cp[1,1], x2,y2, cp[2,0], cp[2,1], x3,y3, cp[3,0], cp[3,1])
-        self.otherPen.curveTo((cp[1,0], cp[1,1]), (cp[2,0], cp[2,1]), (cp[3,0], cp[3,1]))
+        self.curves.append((c[indices], c[startIndex - 1], c[endIndex % n],
+                            self.lastSmooth, self.nextSmooth))
+        self.calls.append(("curveTo", len(self.curves) - 1))
         self.lastPoint = (x3, y3)
         self.lastSmooth = False
 
-    def smoothTangents(self,t1,t2,forceSmooth = False):
-        if forceSmooth or (abs(t1.dot(t2)) > .95 and norm(t1-t2) > 1):
-            # print t1,t2,
-            t1 = (t1 - t2) / 2
-            t2 = -t1
-            # print t1,t2
-        return t1 / norm(t1), t2 / norm(t2)
+    def replay(self, curves):
+        """Draw into otherPen, with the fitted curves of fitCurves."""
+
+        for method, arg in self.calls:
+            if method == "curveTo":
+                cp = curves[arg]
+                self.otherPen.curveTo((cp[1,0], cp[1,1]), (cp[2,0], cp[2,1]),
+                                      (cp[3,0], cp[3,1]))
+            elif method in ("moveTo", "lineTo"):
+                getattr(self.otherPen, method)(arg)
+            elif method == "addComponent":
+                self.otherPen.addComponent(*arg)
+            else:
+                getattr(self.otherPen, method)()
 
     def _closePath(self):
-        self.otherPen.closePath()
+        self.calls.append(("closePath", None))
 
     def _endPath(self):
-        self.otherPen.endPath()
+        self.calls.append(("endPath", None))
 
     def addComponent(self, glyphName, transformation):
-        self.otherPen.addComponent(glyphName, transformation)
+        self.calls.append(("addComponent", (glyphName, transformation)))
 
 
 class SubsegmentPointPen(BasePointToSegmentPen):
@@ -325,6 +321,41 @@ class SubsegmentPen(BasePen):
         return curvePoints
 
 
+def renderCurves(p, counts):
+    """Return the points SubsegmentPen.renderCurve gives for many curves,
+    one curve after the other.
+
+    p holds the curves' control points as a (k, 4, 2) array. The forward
+    differences of all curves are stepped together, so the points are the
+    same as renderCurve's; unlike other ways of evaluating the curves, this
+    keeps the points of straight curves exactly in line.
+    """
+
+    p0, p1, p2, p3 = p[:, 0], p[:, 1], p[:, 2], p[:, 3]
+    t = (1.0 / counts.astype(float)).reshape((-1, 1))
+    temp = t * t
+
+    f = p0
+    fd = 3 * (p1 - p0) * t
+    fdd_per_2 = 3 * (p0 - 2 * p1 + p2) * temp
+    fddd_per_2 = 3 * (3 * (p1 - p2) + p3 - p0) * temp * t
+
+    fddd = fddd_per_2 + fddd_per_2
+    fdd = fdd_per_2 + fdd_per_2
+    fddd_per_6 = fddd_per_2 * (1.0 / 3)
+
+    curvePoints = np.empty((counts.sum(), 2))
+    starts = np.cumsum(counts) - counts
+    for i in range(counts.max()):
+        f = f + fd + fdd_per_2 + fddd_per_6
+        fd = fd + fdd + fddd_per_2
+        fdd = fdd + fddd
+        fdd_per_2 = fdd_per_2 + fddd_per_2
+        active = counts > i
+        curvePoints[starts[active] + i] = f[active]
+    return curvePoints
+
+
 def fitBezierSimple(pts):
     T = [np.linalg.norm(pts[i]-pts[i-1]) for i in range(1,len(pts))]
     tsum = np.sum(T)
@@ -377,7 +408,7 @@ def fitBezier(pts,tangent0=None,tangent3=None):
             TT[i*2+1,j*2+1] = T[i,j+1]
     pout = pout.reshape((n*2,1),order="C")
 
-    if tangent0 != None and tangent3 != None:
+    if tangent0 is not None and tangent3 is not None:
         tangentConstraintsT = np.array([
                 [tangent0[1], -tangent0[0], 0, 0],
                 [0, 0, tangent3[1], -tangent3[0]]
@@ -392,6 +423,165 @@ def fitBezier(pts,tangent0=None,tangent3=None):
     return np.array([pts[0], C[0], C[1], pts[-1]])
 
 
+class SegmentRecordingPointPen(BasePointToSegmentPen):
+    """Records every contour as its start point and its segments, as
+    SubsegmentPointPen would draw them, for segmentContours."""
+
+    def __init__(self):
+        BasePointToSegmentPen.__init__(self)
+        self.contours = []
+
+    def _flushContour(self, segments):
+        assert len(segments) >= 1
+        segmentType, points = segments[0]
+        pt, smooth, name, kwargs = points[0]
+        if len(segments) == 1 and name != None:
+            # an anchor
+            return
+        segmentType, points = segments[-1]
+        movePt, smooth, name, kwargs = points[-1]
+        if segmentType == 'line':
+            del segments[-1]
+        contour = []
+        for segmentType, points in segments:
+            points = [pt for pt, smooth, name, kwargs in points]
+            if segmentType == "qcurve":
+                assert 0, "qcurve not supported"
+            assert segmentType in ("line", "curve"), (
+                "illegal segmentType: %s" % segmentType)
+            contour.append(points)
+        self.contours.append((movePt, contour))
+
+    def addComponent(self, glyphName, transform):
+        pass
+
+
+def smoothTangents(t1, t2, forceSmooth):
+    """Return the directions t1 takes, as rows, once made to line up with t2
+    where forceSmooth is set or they are nearly opposite."""
+
+    smooth = forceSmooth | ((abs((t1 * t2).sum(1)) > .95) &
+                            (rowNorm(t1 - t2) > 1))
+    t1 = np.where(smooth.reshape((-1, 1)), (t1 - t2) / 2, t1)
+    return t1 / rowNorm(t1).reshape((-1, 1))
+
+
+def rowNorm(v):
+    return np.sqrt((v * v).sum(1))
+
+
+def fitCurves(curves, matchTangents=True):
+    """Fit cubic curves to the points recorded by SubsegmentsToCurvesPen,
+    all at once, and return their control points as a (k, 4, 2) array.
+
+    The ends of each curve follow the directions to the points around them,
+    or the average of both if they are smooth, as long as matchTangents is
+    set.
+    """
+
+    points = [c[0] for c in curves]
+    if not matchTangents:
+        return fitBeziers(points)
+    first = np.array([p[0] for p in points])
+    second = np.array([p[1] for p in points])
+    beforeLast = np.array([p[-2] for p in points])
+    last = np.array([p[-1] for p in points])
+    prevPoints = np.array([c[1] for c in curves], dtype=float)
+    nextPoints = np.array([c[2] for c in curves], dtype=float)
+    lastSmooth = np.array([c[3] for c in curves], dtype=bool)
+    nextSmooth = np.array([c[4] for c in curves], dtype=bool)
+
+    unit = lambda v: v / rowNorm(v).reshape((-1, 1))
+    tangent1 = smoothTangents(
+        unit(second - first), unit(prevPoints - first), lastSmooth)
+    tangent3 = smoothTangents(
+        unit(beforeLast - last), unit(nextPoints - last), nextSmooth)
+    cp = fitBeziers(points, tangent1, tangent3)
+    cp[:, 1] = (rowNorm(cp[:, 1] - cp[:, 0]).reshape((-1, 1)) *
+                unit(tangent1) + cp[:, 0])
+    cp[:, 2] = (rowNorm(cp[:, 2] - cp[:, 3]).reshape((-1, 1)) *
+                unit(tangent3) + cp[:, 3])
+    return cp
+
+
+def fitBeziers(points, tangent0=None, tangent3=None):
+    """Fit a cubic curve to each of a list of runs of points, like fitBezier
+    but all at once.
+
+    The least squares problem of every curve only has four unknowns, its
+    inner control points, so it's solved through its 4x4 normal equations,
+    which are built for all curves with a few sums over all points and
+    solved together. Returns the control points as a (k, 4, 2) array.
+    """
+
+    k = len(points)
+    counts = np.array([len(p) for p in points])
+    pts = np.concatenate(points).astype(float)
+
+    # subdivide every run, as fitBezier does: its points, with the midpoints
+    # of every pair in between
+    runs = np.repeat(np.arange(k), counts)
+    runStarts = np.cumsum(counts) - counts
+    position = 2 * np.arange(len(pts)) - runs
+    pairs = np.ones(len(pts), dtype=bool)
+    pairs[runStarts + counts - 1] = False
+    pairs = np.flatnonzero(pairs)
+    sub = np.empty((2 * len(pts) - k, 2))
+    sub[position] = pts
+    sub[position[pairs] + 1] = pts[pairs] + (pts[pairs + 1] - pts[pairs]) * .5
+    subCounts = 2 * counts - 1
+    subRuns = np.repeat(np.arange(k), subCounts)
+    subStarts = np.cumsum(subCounts) - subCounts
+    subEnds = subStarts + subCounts - 1
+
+    # parameterize every run by the length along it
+    chords = np.zeros(len(sub))
+    chords[1:] = rowNorm(sub[1:] - sub[:-1])
+    chords[subStarts] = 0
+    lengths = np.cumsum(chords)
+    lengths -= lengths[subStarts][subRuns]
+    t = lengths / lengths[subEnds][subRuns]
+    M = np.array([[-1,  3, -3, 1],
+                  [ 3, -6,  3, 0],
+                  [-3,  3,  0, 0],
+                  [ 1,  0,  0, 0]])
+    T = np.column_stack((t**3, t**2, t, np.ones(len(t)))).dot(M)
+    start, end = sub[subStarts], sub[subEnds]
+    residual = (sub - T[:, :1] * start[subRuns] - T[:, 3:] * end[subRuns])
+
+    # normal equations in (c1x, c1y, c2x, c2y)
+    total = lambda v: np.bincount(subRuns, weights=v, minlength=k)
+    b11 = total(T[:, 1] * T[:, 1])
+    b12 = total(T[:, 1] * T[:, 2])
+    b22 = total(T[:, 2] * T[:, 2])
+    A = np.zeros((k, 4, 4))
+    A[:, 0, 0] = A[:, 1, 1] = b11
+    A[:, 0, 2] = A[:, 2, 0] = A[:, 1, 3] = A[:, 3, 1] = b12
+    A[:, 2, 2] = A[:, 3, 3] = b22
+    b = np.column_stack((
+        total(T[:, 1] * residual[:, 0]), total(T[:, 1] * residual[:, 1]),
+        total(T[:, 2] * residual[:, 0]), total(T[:, 2] * residual[:, 1])))
+
+    if tangent0 is not None and tangent3 is not None:
+        # keep the inner control points on the lines through the ends in
+        # the tangents' directions, weighted as fitBezier does
+        for columns, tangent, p in (
+                ((0, 1), tangent0, start), ((2, 3), tangent3, end)):
+            row = np.zeros((k, 4))
+            row[:, columns[0]] = tangent[:, 1] * 1000
+            row[:, columns[1]] = -tangent[:, 0] * 1000
+            target = (p[:, 1] * -tangent[:, 0] + p[:, 0] * tangent[:, 1]) * 1000
+            A += row[:, :, None] * row[:, None, :]
+            b += row * target.reshape((-1, 1))
+
+    try:
+        C = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        C = np.array([np.linalg.lstsq(a, v)[0] for a, v in zip(A, b)])
+    return np.concatenate((start[:, None], C.reshape((k, 2, 2)),
+                           end[:, None]), axis=1)
+
+
 def segmentGlyph(glyph,resolution=50):
     g1 = glyph.copy()
     g1.clear()
@@ -400,17 +590,131 @@ def segmentGlyph(glyph,resolution=50):
     return g1, dp.getSubsegments()
 
 
+def segmentContours(glyph, resolution=50):
+    """Split a glyph's segments into subsegments, like segmentGlyph.
+
+    Returns the subsegment points of all contours as an (n, 2) array, in
+    the order of segmentGlyph's points, and the subsegments of each contour
+    as an array of [end index, count] rows. The points of all segments are
+    evaluated together, rather than drawn into a glyph one by one, and are
+    the same as segmentGlyph's.
+    """
+
+    pen = SegmentRecordingPointPen()
+    glyph.drawPoints(pen)
+
+    # every segment as four control points (lines only use the last), with
+    # a line closing contours which don't end at their start
+    starts, controls, isCurve, contourIds = [], [], [], []
+    for i, (startPoint, segments) in enumerate(pen.contours):
+        last = startPoint
+        if segments and tuple(segments[-1][-1]) != tuple(startPoint):
+            segments = segments + [[startPoint]]
+        for points in segments:
+            if len(points) == 3:
+                controls.append([last] + points)
+            else:
+                controls.append([last, last, last, points[0]])
+            starts.append(startPoint)
+            isCurve.append(len(points) == 3)
+            contourIds.append(i)
+            last = points[-1]
+    if not controls:
+        return np.zeros((0, 2)), []
+    controls = np.array(controls, dtype=float)
+    starts = np.array(starts, dtype=float)
+    isCurve = np.array(isCurve)
+    contourIds = np.array(contourIds)
+    p0, p3 = controls[:, 0], controls[:, 3]
+
+    dist = np.sqrt(((p3 - p0) ** 2).sum(1))
+    counts = np.maximum((dist / resolution).astype(int),
+                        np.where(isCurve, 2, 1))
+
+    # the points of every segment, at 1/count, 2/count ... 1
+    segment = np.repeat(np.arange(len(counts)), counts)
+    firsts = np.cumsum(counts) - counts
+    steps = (np.arange(len(segment)) - firsts[segment] + 1).reshape((-1, 1))
+    count = counts[segment].reshape((-1, 1))
+    points = p0[segment] + (p3[segment] - p0[segment]) * steps / count
+    if isCurve.any():
+        points[isCurve[segment]] = renderCurves(
+            controls[isCurve], counts[isCurve])
+    # curves ending at the contour's start leave that point out
+    keep = ~((steps[:, 0] == count[:, 0]) & isCurve[segment] &
+             (p3 == starts).all(1)[segment])
+
+    contourPoints = []
+    subsegments = []
+    for i, (startPoint, unused) in enumerate(pen.contours):
+        contour = points[(contourIds[segment] == i) & keep].tolist()
+        if not contour:
+            contourPoints.append([])
+            subsegments.append(np.zeros((1, 2), dtype=int))
+            continue
+        # round the start and end of the contour and merge them if they are
+        # the same, as segmentGlyph's pen does (see SubsegmentPen._closePath)
+        first = [round(n, 5) for n in startPoint]
+        contour[-1] = [round(n, 5) for n in contour[-1]]
+        if contour[-1] == first:
+            first = contour.pop()
+        contourPoints.append([first] + contour)
+        contourCounts = counts[contourIds == i]
+        subsegments.append(np.column_stack((
+            np.concatenate(([0], np.cumsum(contourCounts))),
+            np.concatenate(([0], contourCounts)))))
+    return (np.array([p for c in contourPoints for p in c],
+                     dtype=float).reshape((-1, 2)),
+            subsegments)
+
+
 def fitGlyph(glyph, subsegmentGlyph, subsegmentIndices, matchTangents=True):
-    outGlyph = glyph.copy()
-    outGlyph.clear()
-    fitPen = SubsegmentsToCurvesPointPen(outGlyph, subsegmentGlyph, subsegmentIndices)
-    fitPen.setMatchTangents(matchTangents)
-    # smoothPen = GuessSmoothPointPen(fitPen)
-    glyph.drawPoints(fitPen)
+    contourPoints = [
+        np.array([(s.points[0].x, s.points[0].y) for s in c.segments])
+        for c in subsegmentGlyph.contours]
+    outGlyph = fitContours(
+        glyph, contourPoints, subsegmentIndices, matchTangents)
     outGlyph.width = subsegmentGlyph.width
     return outGlyph
 
 
+def fitContours(glyph, points, subsegmentIndices, matchTangents=True):
+    """Return a glyph with the segments of glyph fitted to subsegment points,
+    given by contour or as one array like segmentContours returns."""
+
+    return fitGlyphs([glyph], [points], [subsegmentIndices], matchTangents)[0]
+
+
+def fitGlyphs(glyphs, points, subsegmentIndices, matchTangents=True):
+    """fitContours for many glyphs, fitting the curves of all of them at
+    once."""
+
+    outGlyphs = []
+    pens = []
+    for glyph, glyphPoints, subsegments in zip(
+            glyphs, points, subsegmentIndices):
+        if isinstance(glyphPoints, np.ndarray):
+            ends = np.cumsum([c[-1][0] for c in subsegments])
+            glyphPoints = np.split(glyphPoints, ends[:-1])
+        outGlyph = glyph.copy()
+        outGlyph.clear()
+        fitPen = SubsegmentsToCurvesPointPen(
+            outGlyph, glyphPoints, subsegments)
+        # smoothPen = GuessSmoothPointPen(fitPen)
+        glyph.drawPoints(fitPen)
+        outGlyphs.append(outGlyph)
+        pens.append(fitPen.subPen)
+
+    curves = [curve for pen in pens for curve in pen.curves]
+    if curves:
+        curves = fitCurves(curves, matchTangents)
+    offset = 0
+    for pen in pens:
+        pen.replay(curves[offset:offset + len(pen.curves)])
+        offset += len(pen.curves)
+    return outGlyphs
+
+
 if __name__ == '__main__':
     p = SubsegmentPen(None, None)
     pts = np.array([
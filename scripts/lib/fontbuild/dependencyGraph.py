@@ -0,0 +1,82 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from fontbuild.generateGlyph import parseComposite
+
+
+class GlyphDependencyGraph:
+    """Records which glyphs are built from which other glyphs.
+
+    A glyph depends on another if its output can change when the other glyph
+    changes: it uses it as a component (which covers the glyphs flattened by
+    decomposeGlyph), it is composed from it by a diacritic rule, or the two
+    swap contours.
+    """
+
+    def __init__(self):
+        self.dependencies = {}
+        self.dependents = {}
+
+    def addDependency(self, glyphName, dependencyName):
+        self.dependencies.setdefault(glyphName, set()).add(dependencyName)
+        self.dependents.setdefault(dependencyName, set()).add(glyphName)
+
+    def addComponents(self, font):
+        for g in font:
+            for c in g.components:
+                self.addDependency(g.name, c.baseGlyph)
+
+    def addCompositeRules(self, rules):
+        """Add the dependencies of diacritic rules, as used by generateGlyph.
+        """
+
+        for rule in rules:
+            if rule.startswith("#") or rule == "":
+                continue
+            glyphName, baseName, accentNames, offset = parseComposite(rule)
+            for name in baseName.split("_"):
+                self.addDependency(glyphName, name)
+            for accent in accentNames:
+                self.addDependency(glyphName, accent[0])
+
+    def addSwaps(self, glyphNames, suffixes):
+        """Add dependencies between glyphs swapped by swapContours."""
+
+        for suffix in suffixes:
+            for name in glyphNames:
+                if name.endswith(suffix):
+                    baseName = name.replace(suffix, "")
+                    self.addDependency(baseName, name)
+                    self.addDependency(name, baseName)
+
+    def affectedBy(self, glyphNames):
+        """Return the given glyphs plus all glyphs depending on them."""
+
+        return self._closure(glyphNames, self.dependents)
+
+    def requiredFor(self, glyphNames):
+        """Return the given glyphs plus all glyphs they depend on."""
+
+        return self._closure(glyphNames, self.dependencies)
+
+    def _closure(self, glyphNames, edges):
+        found = set(glyphNames)
+        stack = list(found)
+        while stack:
+            for name in edges.get(stack.pop(), ()):
+                if name not in found:
+                    found.add(name)
+                    stack.append(name)
+        return found
@@ -17,19 +17,75 @@ import math
 
 from fontTools.misc.transform import Transform
 import numpy as np
-from numpy.linalg import norm
-from scipy.sparse.linalg import cg
-from scipy.ndimage.filters import gaussian_filter1d as gaussian
+from robofab.objects.objectsRF import RContour, RGlyph, RPoint, RSegment
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import factorized
 from scipy.cluster.vq import vq, whiten
 
 from fontbuild.alignpoints import alignCorners
-from fontbuild.curveFitPen import fitGlyph, segmentGlyph
+from fontbuild.curveFitPen import fitContours, fitGlyphs, segmentContours
 
 
-def italicizeGlyph(f, g, angle=10, stemWidth=185):
+def italicizeGlyph(f, g, angle=10, stemWidth=185, contours=None):
+    """Italicize a glyph of a font.
+
+    contours, if given, are the glyph's italicized contours as returned by
+    italicizeContours, e.g. by another process.
+    """
+
     unic = g.unicode #save unicode
 
     glyph = f[g.name]
+    xoffset, m = italicTransform(angle)
+
+    if contours is not None:
+        g2 = glyph.copy()
+        g2.clearContours()
+        unpackContours(contours, g2)
+        f.insertGlyph(g2, g.name)
+    elif len(glyph) > 0:
+        g2 = italicize(f[g.name], angle, xoffset=xoffset, stemWidth=stemWidth)
+        f.insertGlyph(g2, g.name)
+
+    transformFLGlyphMembers(f[g.name], m)
+
+    if unic > 0xFFFF: #restore unicode
+        g.unicode = unic
+
+
+def italicizeContours(contours, glyphName, angle=10, stemWidth=185):
+    """Italicize contours packed by packContours, and pack the result.
+
+    Unlike italicizeGlyph this doesn't need the glyph's font, so it can run
+    in worker processes which are only sent the contours.
+    """
+
+    glyph = RGlyph()
+    glyph.name = glyphName
+    unpackContours(contours, glyph)
+    xoffset, unused = italicTransform(angle)
+    return packContours(
+        italicize(glyph, angle, xoffset=xoffset, stemWidth=stemWidth))
+
+
+def italicizeContourBatch(contours, glyphNames, angle=10, stemWidth=185):
+    """Italicize the packed contours of many glyphs at once, like
+    italicizeContours, with italicizeGlyphs."""
+
+    glyphs = []
+    for glyphContours, glyphName in zip(contours, glyphNames):
+        glyph = RGlyph()
+        glyph.name = glyphName
+        unpackContours(glyphContours, glyph)
+        glyphs.append(glyph)
+    xoffset, unused = italicTransform(angle)
+    return [packContours(g) for g in italicizeGlyphs(
+        glyphs, angle, xoffset=xoffset, stemWidth=stemWidth)]
+
+
+def italicTransform(angle):
+    """Return the x offset and transform used to slant a glyph's members."""
+
     slope = np.tanh(math.pi * angle / 180)
 
     # determine how far on the x axis the glyph should slide
@@ -38,46 +94,55 @@ def italicizeGlyph(f, g, angle=10, stemWidth=185):
     MEAN_YCENTER = -600
     m = Transform(1, 0, slope, 1, 0, 0)
     xoffset, junk = m.transformPoint((0, MEAN_YCENTER))
-    m = Transform(.97, 0, slope, 1, xoffset, 0)
+    return xoffset, Transform(.97, 0, slope, 1, xoffset, 0)
 
-    if len(glyph) > 0:
-        g2 = italicize(f[g.name], angle, xoffset=xoffset, stemWidth=stemWidth)
-        f.insertGlyph(g2, g.name)
 
-    transformFLGlyphMembers(f[g.name], m)
+def italicize(glyph, angle=12, stemWidth=180, xoffset=-50):
+    return italicizeGlyphs([glyph], angle, stemWidth, xoffset)[0]
 
-    if unic > 0xFFFF: #restore unicode
-        g.unicode = unic
 
+def italicizeGlyphs(glyphs, angle=12, stemWidth=180, xoffset=-50):
+    """italicize many glyphs at once, and return the italicized glyphs.
+
+    The meshes of all glyphs are put together into one, so that every pass
+    runs the mesh operators once on all vertices and solves a single
+    block-diagonal system, rather than one per glyph.
+    """
 
-def italicize(glyph, angle=12, stemWidth=180, xoffset=-50):
     CURVE_CORRECTION_WEIGHT = .03
     CORNER_WEIGHT = 10
 
-    # decompose the glyph into smaller segments
-    ga, subsegments = segmentGlyph(glyph,25)
-    va, e  = glyphToMesh(ga)
+    # decompose the glyphs into smaller segments
+    segmented = []
+    meshes = []
+    edges = []
+    controlPoints = []
+    offset = 0
+    for glyph in glyphs:
+        va, subsegments = segmentContours(glyph,25)
+        e = subsegmentEdges(subsegments)
+        segmented.append((subsegments, offset, offset + len(va)))
+        meshes.append(va)
+        edges.append(e + offset)
+        controlPoints.append(findControlPointsInMesh(glyph, va, subsegments))
+        offset += len(va)
+    va = np.concatenate(meshes)
+    e = np.concatenate(edges)
     n = len(va)
-    grad = mapEdges(lambda a,(p,n): normalize(p-a), va, e)
-    cornerWeights = mapEdges(lambda a,(p,n): normalize(p-a).dot(normalize(a-n)), grad, e)[:,0].reshape((-1,1))
+    grad = edgeGradients(va, e)
+    cornerWeights = cornerAngles(grad, e).reshape((-1,1))
     smooth = np.ones((n,1)) * CURVE_CORRECTION_WEIGHT
 
-    controlPoints = findControlPointsInMesh(glyph, va, subsegments)
+    controlPoints = np.concatenate(controlPoints)
     smooth[controlPoints > 0] = 1
     smooth[cornerWeights < .6] = CORNER_WEIGHT
     # smooth[cornerWeights >= .9999] = 1
 
     out = va.copy()
-    hascurves = False
-    for c in glyph.contours:
-        for s in c.segments:
-            if s.type == "curve":
-                hascurves = True
-                break
-        if hascurves:
-            break
-    if stemWidth > 100:
-        outCorrected = skewMesh(recompose(skewMesh(out, angle * 1.6), grad, e, smooth=smooth), -angle * 1.6)
+    # the mesh's Laplacian, shared by the systems recompose solves
+    M = mP(va, e)
+    if stemWidth > 100 and n > 0:
+        outCorrected = skewMesh(recompose(skewMesh(out, angle * 1.6), grad, e, smooth=smooth, M=M), -angle * 1.6)
         # out = copyMeshDetails(va, out, e, 6)
     else:
         outCorrected = out
@@ -95,8 +160,10 @@ def italicize(glyph, angle=12, stemWidth=180, xoffset=-50):
 
     # make some corrections
     smooth = np.ones((n,1)) * .1
-    out = alignCorners(glyph, out, subsegments)
-    out = copyMeshDetails(skewMesh(va, angle), out, e, 7, smooth=smooth)
+    for glyph, (subsegments, start, end) in zip(glyphs, segmented):
+        out[start:end] = alignCorners(glyph, out[start:end], subsegments)
+    if n > 0:
+        out = copyMeshDetails(skewMesh(va, angle), out, e, 7, smooth=smooth, M=M)
     # grad = mapEdges(lambda a,(p,n): normalize(p-a), skewMesh(outCorrected, angle*.9), e)
     # out = recompose(out, grad, e, smooth=smooth)
 
@@ -104,13 +171,11 @@ def italicize(glyph, angle=12, stemWidth=180, xoffset=-50):
     out[:,0] += xoffset
     # out[:,1] = outCorrected[:,1]
     out[va[:,1] == 0, 1] = 0
-    gOut = meshToGlyph(out, ga)
-    # gOut.width *= .97
-    # gOut.width += 10
-    # return gOut
 
-    # recompose the glyph into original segments
-    return fitGlyph(glyph, gOut, subsegments)
+    # recompose the glyphs into original segments
+    return fitGlyphs(
+        glyphs, [out[start:end] for subsegments, start, end in segmented],
+        [subsegments for subsegments, start, end in segmented])
 
 
 def transformFLGlyphMembers(g, m, transformAnchors = True):
@@ -128,35 +193,64 @@ def transformFLGlyphMembers(g, m, transformAnchors = True):
                 # a.x = a.x - m[4]
 
 
-def glyphToMesh(g):
-    points = []
-    edges = {}
+def subsegmentEdges(subsegments):
+    """Return the edges of the mesh of subsegment points segmentContours
+    returns, as the indices of every point's previous and next point in an
+    array of (prev, next) rows."""
+
+    edges = []
     offset = 0
-    for c in g.contours:
-        if len(c) < 2:
-            continue
-        for i,prev,next in rangePrevNext(len(c)):
-            points.append((c[i].points[0].x, c[i].points[0].y))
-            edges[i + offset] = np.array([prev + offset, next + offset], dtype=int)
-        offset += len(c)
-    return np.array(points), edges
-
-
-def meshToGlyph(points, g):
-    g1 = g.copy()
-    j = 0
-    for c in g1.contours:
-        if len(c) < 2:
+    for c in subsegments:
+        count = c[-1][0]
+        if count < 2:
             continue
-        for i in range(len(c)):
-            c[i].points[0].x = points[j][0]
-            c[i].points[0].y = points[j][1]
-            j += 1
-    return g1
+        edges.append(rangePrevNext(count)[:, 1:] + offset)
+        offset += count
+    if not edges:
+        return np.zeros((0, 2), dtype=int)
+    return np.concatenate(edges)
+
+
+def packContours(glyph):
+    """Return a glyph's contours as an array of point coordinates, a list of
+    point types and the length and smoothness of every segment, by contour.
+    """
+
+    coordinates = []
+    pointTypes = []
+    segments = []
+    for c in glyph.contours:
+        segments.append([(len(s.points), s.smooth) for s in c.segments])
+        for p in c.points:
+            coordinates.append((p.x, p.y))
+            pointTypes.append(p.type)
+    return (np.array(coordinates, dtype=float).reshape((-1, 2)), pointTypes,
+            segments)
+
+
+def unpackContours(contours, g):
+    """Append contours packed by packContours to a glyph."""
+
+    coordinates, pointTypes, segments = contours
+    i = 0
+    for contourSegments in segments:
+        c = RContour()
+        c.setParent(g)
+        for count, smooth in contourSegments:
+            s = RSegment()
+            s.setParent(c)
+            s.smooth = smooth
+            for j in range(i, i + count):
+                p = RPoint(coordinates[j, 0], coordinates[j, 1], pointTypes[j])
+                p.setParent(s)
+                s.points.append(p)
+            c.segments.append(s)
+            i += count
+        g.contours.append(c)
 
 
 def quantizeGradient(grad, book=None):
-    if book == None:
+    if book is None:
         book = np.array([(1,0),(0,1),(0,-1),(-1,0)])
     indexArray = vq(whiten(grad), book)[0]
     out = book[indexArray]
@@ -178,32 +272,44 @@ def findControlPointsInMesh(glyph, va, subsegments):
     return controlPointIndices
 
 
-def recompose(v, grad, e, smooth=1, P=None, distance=None):
+def recompose(v, grad, e, smooth=1, P=None, distance=None, M=None):
+    """Return the mesh whose edges best follow grad, pulled towards v by
+    smooth (a number, or one per vertex).
+
+    P is the sparse system to solve, by default the Laplacian M (see mP)
+    plus smooth on the diagonal. It's factorized once for all columns.
+    """
+
     n = len(v)
-    if distance == None:
-        distance = mapEdges(lambda a,(p,n): norm(p - a), v, e)
-    if (P == None):
-        P = mP(v,e)
-        P += np.identity(n) * smooth
-    f = v.copy()
-    for i,(prev,next) in e.iteritems():
-        f[i] = (grad[next] * distance[next] - grad[i] * distance[i])
+    prev, next = e[:, 0], e[:, 1]
+    if distance is None:
+        distance = rowNorms(v[prev] - v).reshape((-1, 1))
+    if (P is None):
+        if M is None:
+            M = mP(v,e)
+        P = M + diags(np.ones(n) * np.ravel(smooth))
+    solve = factorized(P.tocsc())
+    f = grad[next] * distance[next] - grad * distance
     out = v.copy()
     f += v * smooth
     for i in range(len(out[0,:])):
-        out[:,i] = cg(P, f[:,i])[0]
+        out[:,i] = solve(f[:,i])
     return out
 
 
 def mP(v,e):
+    """Return the Laplacian of a mesh as a sparse (CSR) matrix."""
+
     n = len(v)
-    M = np.zeros((n,n))
-    for i, edges in e.iteritems():
-        w = -2 / float(len(edges))
-        for index in edges:
-            M[i,index] = w
-        M[i,i] = 2
-    return M
+    prev, next = e[:, 0], e[:, 1]
+    rows = np.arange(n)
+    weights = -np.ones(n)
+    # a neighbour on both sides (in a contour of two) still counts once
+    nextWeights = np.where(prev == next, 0., -1.)
+    return csr_matrix(
+        (np.concatenate((weights, nextWeights, np.ones(n) * 2)),
+         (np.tile(rows, 3), np.concatenate((prev, next, rows)))),
+        shape=(n, n))
 
 
 def normalize(v):
@@ -213,13 +319,38 @@ def normalize(v):
     return v/n
 
 
+def rowNorms(v):
+    return np.sqrt((v * v).sum(1))
+
+
+def normalizeRows(v):
+    """Normalize every row of an array, all at once."""
+
+    n = rowNorms(v).reshape((-1, 1))
+    return v / np.where(n == 0, 1, n)
+
+
 def mapEdges(func,v,e,*args):
     b = v.copy()
-    for i, edges in e.iteritems():
+    for i, edges in enumerate(e):
         b[i] = func(v[i], [v[j] for j in edges], *args)
     return b
 
 
+def edgeGradients(v, e):
+    """Return the direction from every vertex to its previous one."""
+
+    return normalizeRows(v[e[:, 0]] - v)
+
+
+def cornerAngles(grad, e):
+    """Return the cosine of the angle at every vertex between the changes of
+    the gradient on either side, from the gradients of edgeGradients."""
+
+    return (normalizeRows(grad[e[:, 0]] - grad) *
+            normalizeRows(grad - grad[e[:, 1]])).sum(1)
+
+
 def getNormal(a,b,c):
     "Assumes TT winding direction"
     p = np.roll(normalize(b - a), 1)
@@ -232,7 +363,11 @@ def getNormal(a,b,c):
 
 def edgeNormals(v,e):
     "Assumes a mesh where each vertex has exactly least two edges"
-    return mapEdges(lambda a,(p,n) : getNormal(a,p,n),v,e)
+    # getNormal for all vertices at once
+    p = normalizeRows(v[e[:, 0]] - v)
+    n = normalizeRows(v[e[:, 1]] - v)
+    return normalizeRows(
+        np.column_stack((p[:, 1] - n[:, 1], n[:, 0] - p[:, 0])) * .5)
 
 
 def rangePrevNext(count):
@@ -242,52 +377,70 @@ def rangePrevNext(count):
 
 
 def skewMesh(v,angle):
-    slope = np.tanh([math.pi * angle / 180])
+    slope = np.tanh(math.pi * angle / 180)
     return v.dot(np.array([[1,0],[slope,1]]))
 
 
 def labelConnected(e):
-    label = 0
+    # contours end where the next vertex wraps around to their first
+    ends = e[:, 1] <= np.arange(len(e))
     labels = np.zeros((len(e),1))
-    for i,(prev,next) in e.iteritems():
-        labels[i] = label
-        if next <= i:
-            label += 1
+    labels[1:, 0] = np.cumsum(ends[:-1])
     return labels
 
 
+def contourGaussian(e, sigma):
+    """Return the neighbours of every vertex within a gaussian's radius, in
+    its contour and wrapping around it, and their weights.
+
+    Like scipy.ndimage's gaussian_filter1d in "wrap" mode applied to every
+    contour, which the weighted sum of values[neighbours] is.
+    """
+
+    radius = int(4 * sigma + .5)
+    offsets = np.arange(-radius, radius + 1)
+    weights = np.exp(-.5 / (sigma * sigma) * offsets * offsets)
+    weights /= weights.sum()
+
+    labels = labelConnected(e)[:, 0].astype(int)
+    starts = np.searchsorted(labels, labels)
+    lengths = np.bincount(labels)[labels]
+    positions = np.arange(len(e)) - starts
+    neighbours = (starts.reshape((-1, 1)) +
+                  (positions.reshape((-1, 1)) + offsets) %
+                  lengths.reshape((-1, 1)))
+    return neighbours, weights
+
+
 def copyGradDetails(a,b,e,scale=15):
-    n = len(a)
-    labels = labelConnected(e)
-    out = a.astype(float).copy()
-    for i in range(labels[-1]+1):
-        mask = (labels==i).flatten()
-        out[mask,:] = gaussian(b[mask,:], scale, mode="wrap", axis=0) + a[mask,:] - gaussian(a[mask,:], scale, mode="wrap", axis=0)
-    return out
+    neighbours, weights = contourGaussian(e, scale)
+    blur = lambda v: np.tensordot(v[neighbours], weights, axes=([1], [0]))
+    return blur(b) + a - blur(a)
 
 
-def copyMeshDetails(va,vb,e,scale=5,smooth=.01):
-    gradA = mapEdges(lambda a,(p,n): normalize(p-a), va, e)
-    gradB = mapEdges(lambda a,(p,n): normalize(p-a), vb, e)
+def copyMeshDetails(va,vb,e,scale=5,smooth=.01,M=None):
+    gradA = edgeGradients(va, e)
+    gradB = edgeGradients(vb, e)
     grad = copyGradDetails(gradA, gradB, e, scale)
-    grad = mapEdges(lambda a,(p,n): normalize(a), grad, e)
-    return recompose(vb, grad, e, smooth=smooth)
+    grad = normalizeRows(grad)
+    return recompose(vb, grad, e, smooth=smooth, M=M)
 
 
 def condenseGlyph(glyph, scale=.8, stemWidth=185):
-    ga, subsegments = segmentGlyph(glyph, 25)
-    va, e  = glyphToMesh(ga)
+    va, subsegments = segmentContours(glyph, 25)
+    e = subsegmentEdges(subsegments)
     n = len(va)
 
     normals = edgeNormals(va,e)
     cn = va.dot(np.array([[scale, 0],[0,1]]))
-    grad = mapEdges(lambda a,(p,n): normalize(p-a), cn, e)
+    grad = edgeGradients(cn, e)
     # ograd = mapEdges(lambda a,(p,n): normalize(p-a), va, e)
 
     cn[:,0] -= normals[:,0] * stemWidth * .5 * (1 - scale)
-    out = recompose(cn, grad, e, smooth=.5)
+    M = mP(va, e)
+    out = recompose(cn, grad, e, smooth=.5, M=M)
     # out = recompose(out, grad, e, smooth=.1)
-    out = recompose(out, grad, e, smooth=.01)
+    out = recompose(out, grad, e, smooth=.01, M=M)
 
     # cornerWeights = mapEdges(lambda a,(p,n): normalize(p-a).dot(normalize(a-n)), grad, e)[:,0].reshape((-1,1))
     #     smooth = np.ones((n,1)) * .1
@@ -300,8 +453,7 @@ def condenseGlyph(glyph, scale=.8, stemWidth=185):
     out[:,0] += 15
     out[:,1] = va[:,1]
     # out = recompose(out, grad, e, smooth=.5)
-    gOut = meshToGlyph(out, ga)
-    gOut = fitGlyph(glyph, gOut, subsegments)
+    gOut = fitContours(glyph, out, subsegments)
     for i,seg in enumerate(gOut):
         gOut[i].points[0].y = glyph[i].points[0].y
     return gOut
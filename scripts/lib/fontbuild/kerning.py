@@ -0,0 +1,95 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Kerning of masters and instances, held as arrays.
+
+A master's kerning is read once, and then shared by its copies and by the
+instances mixed from it rather than copied as dicts. It's only turned back
+into pairs when written into a font.
+"""
+
+
+from numpy import array, int32
+
+
+class KerningTable(object):
+    """Kerning pairs as indices into a list of names, and their values.
+
+    Pairs are sorted by name. Tables never change once made and their arrays
+    are read-only, so that they can be shared; tables of other values for the
+    same pairs (e.g. interpolated ones) are made by withValues.
+    """
+
+    __slots__ = ("names", "left", "right", "values")
+
+    def __init__(self, names=(), left=(), right=(), values=()):
+        self.names = tuple(names)
+        self.left = readOnly(array(left, dtype=int32))
+        self.right = readOnly(array(right, dtype=int32))
+        # ints stay ints, for kerning to be written as it was read
+        self.values = readOnly(array(values))
+
+    @classmethod
+    def fromDict(cls, kerning):
+        """Return a table of the pairs of a dict, or a RoboFab kerning."""
+
+        pairs = sorted(kerning.keys())
+        names = sorted(set(name for pair in pairs for name in pair))
+        ids = dict((name, i) for i, name in enumerate(names))
+        return cls(names, [ids[left] for left, right in pairs],
+                   [ids[right] for left, right in pairs],
+                   [kerning[pair] for pair in pairs])
+
+    def withValues(self, values):
+        """Return a table of the same pairs with other values."""
+
+        table = KerningTable.__new__(KerningTable)
+        table.names = self.names
+        table.left = self.left
+        table.right = self.right
+        table.values = readOnly(array(values))
+        return table
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getstate__(self):
+        return self.names, self.left, self.right, self.values
+
+    def __setstate__(self, state):
+        self.names = state[0]
+        self.left, self.right, self.values = [readOnly(a) for a in state[1:]]
+
+    def pairs(self):
+        names = self.names
+        return [(names[left], names[right]) for left, right in
+                zip(self.left.tolist(), self.right.tolist())]
+
+    def items(self):
+        return zip(self.pairs(), self.values.tolist())
+
+    def asDict(self):
+        return dict(self.items())
+
+    def copyToKerning(self, kerning):
+        """Replace the pairs of a RoboFab font's kerning with the table's."""
+
+        kerning.clear()
+        kerning.update(self.asDict())
+
+
+def readOnly(values):
+    values.flags.writeable = False
+    return values
@@ -13,6 +13,9 @@
 # limitations under the License.
 
 
+from fontTools.feaLib.ast import FeatureBlock
+from fontTools.feaLib.parser import Parser
+from fontTools.misc.py23 import UnicodeIO, tounicode
 from ufo2ft.kernFeatureWriter import KernFeatureWriter
 from ufo2ft.makeotfParts import FeatureOTFCompiler
 
@@ -21,6 +24,22 @@ class RobotoFeatureCompiler(FeatureOTFCompiler):
     def precompile(self):
         self.overwriteFeatures = True
 
+    def _findLayoutFeatures(self):
+        """Return the feature tags defined in the font's features.
+
+        The base class reads them from the features.fea file at the font's
+        path, which is stale (or missing) for fonts compiled from memory.
+        """
+
+        text = self.font.features.text
+        if not text:
+            return set()
+        parser = Parser(
+            UnicodeIO(tounicode(text)),
+            glyphMap=self.outline.getReverseGlyphMap())
+        return set(f.name for f in parser.parse().statements
+                   if isinstance(f, FeatureBlock))
+
     def setupAnchorPairs(self):
         self.anchorPairs = [
             ["top", "_marktop"],
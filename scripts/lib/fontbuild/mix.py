@@ -13,9 +13,13 @@
 # limitations under the License.
 
 
-from numpy import array, append
+from numpy import (
+    array, append, arange, concatenate, empty, floor, sign, tensordot, zeros)
 import copy
 import json
+import os
+from fontTools.varLib.models import VariationModel
+from fontbuild.kerning import KerningTable
 from robofab.objects.objectsRF import RPoint
 from robofab.world import OpenFont
 from decomposeGlyph import decomposeGlyph
@@ -28,14 +32,16 @@ class FFont:
         self.glyphs = {}
         self.hstems = []
         self.vstems = []
-        self.kerning = {}
+        self.kerning = KerningTable()
+        self.packed = None
         if isinstance(f,FFont):
             #self.glyphs = [g.copy() for g in f.glyphs]
             for key,g in f.glyphs.iteritems():
                 self.glyphs[key] = g.copy()
             self.hstems = list(f.hstems)
             self.vstems = list(f.vstems)
-            self.kerning = dict(f.kerning)
+            # read-only, like the glyphs' values
+            self.kerning = f.kerning
         elif f != None:
             self.copyFromFont(f)
 
@@ -44,7 +50,7 @@ class FFont:
             self.glyphs[g.name] = FGlyph(g)
         self.hstems = [s for s in f.info.postscriptStemSnapH]
         self.vstems = [s for s in f.info.postscriptStemSnapV]
-        self.kerning = f.kerning.asDict()
+        self.kerning = KerningTable.fromDict(f.kerning)
 
 
     def copyToFont(self, f):
@@ -56,8 +62,41 @@ class FFont:
                 print "Copy to glyph failed for" + g.name
         f.info.postscriptStemSnapH = self.hstems
         f.info.postscriptStemSnapV = self.vstems
-        for pair in self.kerning:
-            f.kerning[pair] = self.kerning[pair]
+        for pair, value in self.kerning.items():
+            f.kerning[pair] = value
+
+    def pack(self):
+        """Move the data of all glyphs into one array, and return it.
+
+        Returns the glyph names, an array with a row for each glyph's width
+        and one for each pair of its other values (the width has no y value),
+        and each glyph's first row by name. The glyphs' dataX and dataY become
+        views of the array, which is only rebuilt once glyphs are replaced.
+        """
+
+        if self.packed is not None:
+            names, data, starts = self.packed
+            if (len(names) == len(self.glyphs) and all(
+                    self.glyphs.get(n) is g for n, g in self.packedGlyphs)):
+                return self.packed
+
+        names = sorted(self.glyphs)
+        starts = {}
+        count = 0
+        for name in names:
+            starts[name] = count
+            count += len(self.glyphs[name].dataX)
+        data = zeros((count, 2))
+        for name in names:
+            g = self.glyphs[name]
+            start, end = starts[name], starts[name] + len(g.dataX)
+            data[start:end, 0] = g.dataX
+            data[start + 1:end, 1] = g.dataY
+            g.dataX = data[start:end, 0]
+            g.dataY = data[start + 1:end, 1]
+        self.packed = names, data, starts
+        self.packedGlyphs = [(n, self.glyphs[n]) for n in names]
+        return self.packed
 
     def getGlyph(self, gname):
         try:
@@ -79,61 +118,124 @@ class FFont:
                 print "Add diff failed for '%s'" %key
         return newFont
 
-class FGlyph:
-    "provides a temporary floating point compatible glyph data structure"
-    
+class GlyphStructure(object):
+    """What the values of an FGlyph are: the index of its width, and the
+    indices of its components' scale and offset, anchors and points.
+
+    Never changed once made, so that all glyphs made from the same glyph (by
+    copying, arithmetic or interpolation) share it.
+    """
+
+    __slots__ = ("name", "width", "contours", "components", "anchors")
+
+    def __init__(self, name=None, width=0, contours=(), components=(),
+                 anchors=()):
+        self.name = name
+        self.width = width
+        self.contours = tuple(tuple(c) for c in contours)
+        self.components = tuple(components)
+        self.anchors = tuple(anchors)
+
+    def __getstate__(self):
+        return (self.name, self.width, self.contours, self.components,
+                self.anchors)
+
+    def __setstate__(self, state):
+        (self.name, self.width, self.contours, self.components,
+         self.anchors) = state
+
+
+EMPTY_STRUCTURE = GlyphStructure()
+
+
+class FGlyph(object):
+    """provides a temporary floating point compatible glyph data structure
+
+    Glyphs made from others share their structure, and values are never
+    changed in place: copies share them read-only until they are replaced.
+    """
+
+    __slots__ = ("structure", "dataX", "dataY")
+
     def __init__(self, g=None):
-        self.contours = []
-        self.width = 0.
-        self.components = []
-        self.anchors = []
+        self.structure = EMPTY_STRUCTURE
+        self.dataX = zeros(1)
+        self.dataY = zeros(0)
         if g != None:
             self.copyFromGlyph(g)
+
+    @classmethod
+    def fromStructure(cls, structure, dataX, dataY):
+        g = cls.__new__(cls)
+        g.structure = structure
+        g.dataX = dataX
+        g.dataY = dataY
+        return g
+
+    name = property(lambda self: self.structure.name)
+    width = property(lambda self: self.structure.width)
+    contours = property(lambda self: self.structure.contours)
+    components = property(lambda self: self.structure.components)
+    anchors = property(lambda self: self.structure.anchors)
+
+    def __getstate__(self):
+        return self.structure, self.dataX, self.dataY
+
+    def __setstate__(self, state):
+        self.structure, self.dataX, self.dataY = state
         
     def copyFromGlyph(self,g):
-        self.name = g.name
         valuesX = []
         valuesY = []
-        self.width = len(valuesX)
+        width = len(valuesX)
         valuesX.append(g.width)
+        components = []
         for c in g.components:
-            self.components.append((len(valuesX), len(valuesY)))
+            components.append((len(valuesX), len(valuesY)))
             valuesX.append(c.scale[0])
             valuesY.append(c.scale[1])
             valuesX.append(c.offset[0])
             valuesY.append(c.offset[1])
 
+        anchors = []
         for a in g.anchors:
-            self.anchors.append((len(valuesX), len(valuesY)))
+            anchors.append((len(valuesX), len(valuesY)))
             valuesX.append(a.x)
             valuesY.append(a.y)
 
+        contours = []
         for i in range(len(g)):
-            self.contours.append([])
+            contours.append([])
             for j in range (len(g[i].points)):
-                self.contours[i].append((len(valuesX), len(valuesY)))
+                contours[i].append((len(valuesX), len(valuesY)))
                 valuesX.append(g[i].points[j].x)
                 valuesY.append(g[i].points[j].y)
 
+        self.structure = GlyphStructure(
+            g.name, width, contours, components, anchors)
         self.dataX = array(valuesX, dtype=float)
         self.dataY = array(valuesY, dtype=float)
         
     def copyToGlyph(self,g):
-        g.width = self._derefX(self.width)
+        # round all values at once, rather than one by one in _derefX/Y
+        roundedX = roundValues(self.dataX)
+        roundedY = roundValues(self.dataY)
+        g.width = roundedX[self.width]
         if len(g.components) == len(self.components):
             for i in range(len(self.components)):
                 g.components[i].scale = (self._derefX(self.components[i][0] + 0, asInt=False),
                                          self._derefY(self.components[i][1] + 0, asInt=False))
-                g.components[i].offset = (self._derefX(self.components[i][0] + 1),
-                                          self._derefY(self.components[i][1] + 1))
+                g.components[i].offset = (roundedX[self.components[i][0] + 1],
+                                          roundedY[self.components[i][1] + 1])
         if len(g.anchors) == len(self.anchors):
             for i in range(len(self.anchors)):
-                g.anchors[i].x = self._derefX( self.anchors[i][0])
-                g.anchors[i].y = self._derefY( self.anchors[i][1])
+                g.anchors[i].x = roundedX[self.anchors[i][0]]
+                g.anchors[i].y = roundedY[self.anchors[i][1]]
         for i in range(len(g)) :
-            for j in range (len(g[i].points)):
-                g[i].points[j].x = self._derefX(self.contours[i][j][0])
-                g[i].points[j].y = self._derefY(self.contours[i][j][1])
+            points = g[i].points
+            for j in range (len(points)):
+                points[j].x = roundedX[self.contours[i][j][0]]
+                points[j].y = roundedY[self.contours[i][j][1]]
 
     def isCompatible(self, g):
         return (len(self.dataX) == len(g.dataX) and
@@ -142,65 +244,53 @@ class FGlyph:
     
     def __add__(self,g):
         if self.isCompatible(g):
-            newGlyph = self.copy()
-            newGlyph.dataX = self.dataX + g.dataX
-            newGlyph.dataY = self.dataY + g.dataY
-            return newGlyph
+            return self.withData(self.dataX + g.dataX, self.dataY + g.dataY)
         else:
             print "Add failed for '%s'" %(self.name)
             raise Exception
     
     def __sub__(self,g):
         if self.isCompatible(g):
-            newGlyph = self.copy()
-            newGlyph.dataX = self.dataX - g.dataX
-            newGlyph.dataY = self.dataY - g.dataY
-            return newGlyph
+            return self.withData(self.dataX - g.dataX, self.dataY - g.dataY)
         else:
             print "Subtract failed for '%s'" %(self.name)
             raise Exception
     
     def __mul__(self,scalar):
-        newGlyph = self.copy()
-        newGlyph.dataX = self.dataX * scalar
-        newGlyph.dataY = self.dataY * scalar
-        return newGlyph
+        return self.withData(self.dataX * scalar, self.dataY * scalar)
     
     def scaleX(self,scalar):
-        newGlyph = self.copy()
-        if len(self.dataX) > 0:
-            newGlyph.dataX = self.dataX * scalar
-            for i in range(len(newGlyph.components)):
-                newGlyph.dataX[newGlyph.components[i][0]] = self.dataX[newGlyph.components[i][0]]
-        return newGlyph
+        dataX = self.dataX * scalar
+        for i in range(len(self.components)):
+            dataX[self.components[i][0]] = self.dataX[self.components[i][0]]
+        return self.withData(dataX, self.dataY)
         
     def shift(self,ammount):
-        newGlyph = self.copy()
-        newGlyph.dataX = self.dataX + ammount
-        for i in range(len(newGlyph.components)):
-            newGlyph.dataX[newGlyph.components[i][0]] = self.dataX[newGlyph.components[i][0]]
-        return newGlyph
+        dataX = self.dataX + ammount
+        for i in range(len(self.components)):
+            dataX[self.components[i][0]] = self.dataX[self.components[i][0]]
+        return self.withData(dataX, self.dataY)
     
     def interp(self, g, v):
-        gF = self.copy()
         if not self.isCompatible(g):
             print "Interpolate failed for '%s'; outlines incompatible" %(self.name)
             raise Exception
         
-        gF.dataX += (g.dataX - gF.dataX) * v.x
-        gF.dataY += (g.dataY - gF.dataY) * v.y
-        return gF
+        return self.withData(self.dataX + (g.dataX - self.dataX) * v.x,
+                             self.dataY + (g.dataY - self.dataY) * v.y)
     
     def copy(self):
-        ng = FGlyph()
-        ng.contours = list(self.contours)
-        ng.width = self.width
-        ng.components = list(self.components)
-        ng.anchors = list(self.anchors)
-        ng.dataX = self.dataX.copy()
-        ng.dataY = self.dataY.copy()
-        ng.name = self.name
-        return ng
+        return self.withData(self.dataX, self.dataY)
+
+    def withData(self, dataX, dataY):
+        """Return a glyph with the same structure, but the given values,
+        which are made read-only (views) so that glyphs can share them."""
+
+        dataX = dataX.view()
+        dataX.flags.writeable = False
+        dataY = dataY.view()
+        dataY.flags.writeable = False
+        return FGlyph.fromStructure(self.structure, dataX, dataY)
     
     def _derefX(self,id, asInt=True):
         val = self.dataX[id]
@@ -218,12 +308,26 @@ class FGlyph:
 
 class Master:
 
-    def __init__(self, font=None, v=0, kernlist=None, overlay=None):
+    def __init__(self, font=None, v=0, kernlist=None, overlay=None,
+                 snapshots=None):
+        # checked instead of font, which masters from snapshots read lazily
+        self.mix = font if isinstance(font, Mix) else None
+        self.name = os.path.basename(font) if isinstance(font, str) else None
         if isinstance(font, FFont):
             self.font = None
             self.ffont = font
         elif isinstance(font,str):
-            self.openFont(font,overlay)
+            self.ffont = None
+            if snapshots is not None:
+                key = snapshots.key(font, overlay)
+                self.ffont = snapshots.load(key)
+            if self.ffont is None:
+                self.openFont(font,overlay)
+                if snapshots is not None:
+                    snapshots.save(key, self.ffont)
+            else:
+                # the font is only read if it's used
+                self.fontPaths = font, overlay
         elif isinstance(font,Mix):
             self.font = font
         else:
@@ -241,82 +345,495 @@ class Master:
                             if not k[0].startswith("#")
                             and not k[0] == ""]
             #TODO implement class based kerning / external kerning file
+
+    def __getattr__(self, name):
+        if name == "font" and "fontPaths" in self.__dict__:
+            self.font = openMasterFont(*self.__dict__.pop("fontPaths"))
+            return self.font
+        raise AttributeError(name)
     
     def openFont(self, path, overlayPath=None):
-        self.font = OpenFont(path)
-        for g in self.font:
-          size = len(g)
-          csize = len(g.components)
-          if (size > 0 and csize > 0):
-            decomposeGlyph(self.font, g.name)
-
-        if overlayPath != None:
-            overlayFont = OpenFont(overlayPath)
-            font = self.font
-            for overlayGlyph in overlayFont:
-                font.insertGlyph(overlayGlyph)
-
+        self.font = openMasterFont(path, overlayPath)
         self.ffont = FFont(self.font)
 
 
 class Mix:
+    """Interpolation between masters.
+
+    Mixes either two masters by a factor v (a number, or an RPoint with
+    separate factors for x and y values), or the masters of a DesignSpace at
+    a location on its axes.
+
+    Glyphs are mixed the first time they're asked for (see getGlyph) and kept
+    from then on, so that previews and partial builds only pay for the glyphs
+    they use. Full builds mix everything at once, through materialize.
+    """
+
     def __init__(self,masters,v):
+        self.space = None
+        if isinstance(masters, DesignSpace):
+            self.space = masters
+            masters = masters.masters
+        elif len(masters) > 2:
+            raise ValueError("more than two masters need a DesignSpace")
         self.masters = masters
-        if isinstance(v,float) or isinstance(v,int):
+        self.packedRows = None
+        self.mixedGlyphs = {}
+        if self.space is not None:
+            self.v = None
+            self.location = v
+        elif isinstance(v,float) or isinstance(v,int):
             self.v = RPoint(v,v)
         else:
             self.v = v
     
     def getFGlyph(self, master, gname):
-        if isinstance(master.font, Mix):
-            return font.mixGlyphs(gname)
+        if master.mix is not None:
+            return master.mix.getGlyph(gname)
         return master.ffont.getGlyph(gname)
     
     def getGlyphMasters(self,gname):
         masters = self.masters
         if len(masters) <= 2:
             return self.getFGlyph(masters[0], gname), self.getFGlyph(masters[-1], gname)
+
+    def keys(self):
+        """Return the names of the glyphs in the first (or default) master."""
+
+        master = self.masters[0]
+        if self.space is not None:
+            master = self.space.default
+        if master.mix is not None:
+            return master.mix.keys()
+        return master.ffont.glyphs.keys()
+
+    def getGlyph(self, gname):
+        """Return a mixed glyph, which may be shared and shouldn't be changed.
+
+        Returns None if the glyph can't be mixed, like mixGlyphs.
+        """
+
+        try:
+            return self.mixedGlyphs[gname]
+        except KeyError:
+            gF = self.mixedGlyphs[gname] = self.mixGlyphs(gname)
+            return gF
+
+    def materialize(self):
+        """Mix all glyphs which weren't yet, and return all by name."""
+
+        names = [n for n in self.keys() if n not in self.mixedGlyphs]
+        if names:
+            mixed = self.mixAllGlyphs()
+            for name in names:
+                self.mixedGlyphs[name] = mixed.get(name) or self.mixGlyphs(name)
+        return self.mixedGlyphs
     
     def generateFFont(self):
-        ffont = FFont(self.masters[0].ffont)
-        for key,g in ffont.glyphs.iteritems():
-            ffont.glyphs[key] = self.mixGlyphs(key)
+        ffont = FFont()
+        for key,g in self.materialize().iteritems():
+            ffont.glyphs[key] = g.copy() if g is not None else None
+        first = self.masters[0]
+        if self.space is not None:
+            first = self.space.default
+        while first.mix is not None:
+            first = first.mix.masters[0]
+        ffont.hstems = list(first.ffont.hstems)
+        ffont.vstems = list(first.ffont.vstems)
         ffont.kerning = self.mixKerns()
         return ffont
     
-    def generateFont(self, baseFont):
+    def generateFont(self, baseFont, glyphNames=None):
+        """Return a copy of baseFont with the mixed glyphs and kerning.
+
+        If glyphNames is given, only those glyphs are mixed, and the others
+        are left as they are in baseFont.
+        """
+
         newFont = baseFont.copy()
+        if glyphNames is None:
+            self.materialize()
         #self.mixStems(newFont)  todo _ fix stems code
         for g in newFont:
-            gF = self.mixGlyphs(g.name)
+            if glyphNames is not None and g.name not in glyphNames:
+                continue
+            gF = self.getGlyph(g.name)
             if gF == None:
                 g.mark = True
             else:
                 gF.copyToGlyph(g)
-        newFont.kerning.clear()
-        newFont.kerning.update(self.mixKerns() or {})
+        self.mixKerns().copyToKerning(newFont.kerning)
         return newFont
     
+    def mixAllGlyphs(self):
+        """Interpolate the glyphs of the outer masters all at once.
+
+        Works on the masters' packed arrays (see FFont.pack), and returns the
+        glyphs by name as views of a single array. Glyphs which aren't
+        compatible are left out, for mixGlyphs to deal with.
+        """
+
+        if self.space is not None:
+            return self.space.mixAllGlyphs(self.location)
+        masterA, masterB = self.masters[0], self.masters[-1]
+        if masterA.mix is not None or masterB.mix is not None:
+            return {}
+        namesA, dataA, startsA = masterA.ffont.pack()
+        namesB, dataB, startsB = masterB.ffont.pack()
+
+        # rows to take from each master, kept until the masters change
+        if (self.packedRows is None or self.packedRows[0] is not dataA or
+                self.packedRows[1] is not dataB):
+            compatible = compatibilityIndex(self.masters).compatible
+            glyphs = []
+            rowsA = []
+            rowsB = []
+            for name in namesA:
+                if name not in compatible:
+                    continue
+                gA = masterA.ffont.glyphs[name]
+                gB = masterB.ffont.glyphs[name]
+                glyphs.append(gA)
+                rowsA.append(arange(startsA[name], startsA[name] + len(gA.dataX)))
+                rowsB.append(arange(startsB[name], startsB[name] + len(gB.dataX)))
+            if not glyphs:
+                return {}
+            self.packedRows = (dataA, dataB, glyphs, concatenate(rowsA),
+                               concatenate(rowsB))
+        unused, unused, glyphs, rowsA, rowsB = self.packedRows
+
+        a = dataA[rowsA]
+        data = a + (dataB[rowsB] - a) * array([self.v.x, self.v.y], dtype=float)
+        mixed = {}
+        start = 0
+        for gA in glyphs:
+            end = start + len(gA.dataX)
+            mixed[gA.name] = gA.withData(data[start:end, 0],
+                                         data[start + 1:end, 1])
+            start = end
+        return mixed
+
     def mixGlyphs(self,gname):
+        if self.space is not None:
+            return self.space.mixGlyph(gname, self.location)
         gA,gB = self.getGlyphMasters(gname)        
-        try:
+        if gname in compatibilityIndex(self.masters).compatible:
             return gA.interp(gB,self.v)
-        except:
-            print "mixglyph failed for %s" %(gname)
-            if gA != None:
-                return gA.copy()
+        # listed by the index's report, and left as in the first master
+        if gA != None:
+            return gA.copy()
 
     def getKerning(self, master):
-        if isinstance(master.font, Mix):
-            return master.font.mixKerns()
+        if master.mix is not None:
+            return master.mix.mixKerns()
         return master.ffont.kerning
 
     def mixKerns(self):
+        if self.space is not None:
+            return self.space.getKerning(self.location)
         masters = self.masters
         kA, kB = self.getKerning(masters[0]), self.getKerning(masters[-1])
         return interpolateKerns(kA, kB, self.v)
 
 
+class DesignSpace:
+    """Masters at locations on named axes, interpolated like a variable font.
+
+    Locations are dicts of axis values, where missing axes are at 0 and the
+    default master is at {}. The glyphs compatible in all masters are kept as
+    deltas (see fontTools.varLib.models), computed once for every instance,
+    so that mixing an instance is a weighted sum of the deltas. Instances
+    beyond the outermost masters of an axis are extrapolated from its last
+    interval. Masters have to have FFonts, i.e. can't be Mixes.
+    """
+
+    def __init__(self, masters, locations):
+        self.masters = masters
+        self.locations = [dict((axis, v) for axis, v in loc.items() if v != 0)
+                          for loc in locations]
+        self.model = VariationModel(self.locations)
+        self.default = masters[self.locations.index({})]
+        self.axisRanges = {}
+        for loc in self.locations:
+            for axis, v in loc.items():
+                lower, upper = self.axisRanges.get(axis, (0, 0))
+                self.axisRanges[axis] = min(lower, v), max(upper, v)
+        self.packed = None
+
+    def pack(self):
+        """Return the glyphs compatible in all masters and their deltas.
+
+        Returns the default master's glyphs by name, each glyph's first row
+        and an array of deltas, with the rows of values of every delta laid
+        out like FFont.pack.
+        """
+
+        if self.packed is not None:
+            return self.packed
+        packs = [m.ffont.pack() for m in self.masters]
+        compatible = compatibilityIndex(self.masters).compatible
+        glyphs = {}
+        starts = {}
+        rows = [[] for m in self.masters]
+        count = 0
+        for name in sorted(self.default.ffont.glyphs):
+            if name not in compatible:
+                continue
+            g = glyphs[name] = self.default.ffont.glyphs[name]
+            starts[name] = count
+            count += len(g.dataX)
+            for i, (unused, unused, masterStarts) in enumerate(packs):
+                rows[i].append(arange(masterStarts[name],
+                                      masterStarts[name] + len(g.dataX)))
+
+        deltas = zeros((len(self.masters), count, 2))
+        if count:
+            values = [data[concatenate(masterRows)]
+                      for (unused, data, unused), masterRows in zip(packs, rows)]
+            for i, weights in enumerate(self.model.deltaWeights):
+                deltas[i] = values[self.model.reverseMapping[i]]
+                for j, weight in weights.items():
+                    deltas[i] -= deltas[j] * weight
+        self.packed = glyphs, starts, deltas
+        return self.packed
+
+    def getScalars(self, location):
+        """Return the weights of the deltas at location, for x and y values.
+
+        Axis values may be RPoints, to mix x and y values differently.
+        """
+
+        scalars = []
+        for coordinate in ("x", "y"):
+            loc = dict((axis, float(getattr(v, coordinate, v)))
+                       for axis, v in location.items())
+            scalars.append(array(
+                [self.supportScalar(loc, support)
+                 for support in self.model.supports]))
+        return scalars
+
+    def supportScalar(self, location, support):
+        """Return the weight of a delta with the given support at location.
+
+        Like fontTools' supportScalar, but extrapolating linearly beyond the
+        outermost masters.
+        """
+
+        scalar = 1.
+        for axis, (lower, peak, upper) in support.items():
+            v = location.get(axis, 0.)
+            if v == peak:
+                continue
+            axisMin, axisMax = self.axisRanges[axis]
+            if v < axisMin and lower <= axisMin:
+                if peak <= axisMin and peak < upper:
+                    scalar *= (v - upper) / (peak - upper)
+                    continue
+                elif axisMin < peak:
+                    scalar *= (v - lower) / (peak - lower)
+                    continue
+            elif axisMax < v and axisMax <= upper:
+                if axisMax <= peak and lower < peak:
+                    scalar *= (v - lower) / (peak - lower)
+                    continue
+                elif peak < axisMax:
+                    scalar *= (v - upper) / (peak - upper)
+                    continue
+            if v <= lower or upper <= v:
+                return 0.
+            if v < peak:
+                scalar *= (v - lower) / (peak - lower)
+            else:
+                scalar *= (v - upper) / (peak - upper)
+        return scalar
+
+    def mixAllGlyphs(self, location):
+        """Return the compatible glyphs at location by name, as views of a
+        single array."""
+
+        glyphs, starts, deltas = self.pack()
+        scalarsX, scalarsY = self.getScalars(location)
+        data = empty(deltas.shape[1:])
+        data[:, 0] = tensordot(scalarsX, deltas[:, :, 0], 1)
+        data[:, 1] = tensordot(scalarsY, deltas[:, :, 1], 1)
+        mixed = {}
+        for name, g in glyphs.iteritems():
+            start, end = starts[name], starts[name] + len(g.dataX)
+            mixed[name] = g.withData(data[start:end, 0],
+                                     data[start + 1:end, 1])
+        return mixed
+
+    def mixGlyph(self, gname, location):
+        """Return a glyph at location, or a copy of the nearest master's
+        glyph if it isn't compatible in all masters (see CompatibilityIndex).
+        """
+
+        glyphs, starts, deltas = self.pack()
+        if gname not in glyphs:
+            # listed by the index's report
+            for master in self.nearestMasters(location):
+                g = master.ffont.getGlyph(gname)
+                if g is not None:
+                    return g.copy()
+            return None
+        g = glyphs[gname]
+        scalarsX, scalarsY = self.getScalars(location)
+        start, end = starts[gname], starts[gname] + len(g.dataX)
+        return g.withData(tensordot(scalarsX, deltas[:, start:end, 0], 1),
+                          tensordot(scalarsY, deltas[:, start + 1:end, 1], 1))
+
+    def nearestMasters(self, location):
+        """Return the masters by distance from location, nearest first."""
+
+        loc = dict((axis, float(getattr(v, "x", v)))
+                   for axis, v in location.items())
+        axes = set(loc) | set(self.axisRanges)
+        distance = lambda masterLoc: sum(
+            (loc.get(axis, 0.) - masterLoc.get(axis, 0)) ** 2 for axis in axes)
+        order = sorted(range(len(self.masters)),
+                       key=lambda i: distance(self.locations[i]))
+        return [self.masters[i] for i in order]
+
+    def getKerning(self, location):
+        """Return the kerning of the master at the start of the location's
+        interval on every axis, or the default master's.
+
+        Like interpolateKerns, this doesn't actually interpolate kerning.
+        """
+
+        start = {}
+        for axis, v in location.items():
+            positions = sorted(set(
+                [0] + [loc[axis] for loc in self.locations if axis in loc]))
+            v = getattr(v, "x", v)
+            lower = max([p for p in positions[:-1] if p <= v] or positions[:1])
+            if lower != 0:
+                start[axis] = lower
+        if start in self.locations:
+            return self.masters[self.locations.index(start)].ffont.kerning
+        return self.default.ffont.kerning
+
+
+class CompatibilityIndex:
+    """Which glyphs of a set of masters can be interpolated.
+
+    Glyphs are compatible if they're in all masters with the same layout (see
+    glyphLayout). compatible holds their names, and incompatible the reason
+    for every other glyph in any of the masters. Masters which are Mixes are
+    mixed in full to be indexed.
+    """
+
+    def __init__(self, masters):
+        self.masters = masters
+        self.names = [m.name or "master %d" % (i + 1)
+                      for i, m in enumerate(masters)]
+        fonts = []
+        for m in masters:
+            if m.mix is not None:
+                fonts.append(m.mix.materialize())
+            else:
+                fonts.append(m.ffont.glyphs)
+        allNames = set()
+        for glyphs in fonts:
+            allNames.update(n for n, g in glyphs.iteritems() if g is not None)
+
+        self.compatible = set()
+        self.incompatible = {}
+        for gname in allNames:
+            reason = self.checkGlyph([glyphs.get(gname) for glyphs in fonts])
+            if reason is None:
+                self.compatible.add(gname)
+            else:
+                self.incompatible[gname] = reason
+
+    def checkGlyph(self, glyphs):
+        """Return why the masters' glyphs can't be interpolated, or None."""
+
+        for name, g in zip(self.names, glyphs):
+            if g is None:
+                return "not in %s" % name
+        layouts = [glyphLayout(g) for g in glyphs]
+        contours, components, anchors = layouts[0]
+        for name, layout in zip(self.names, layouts)[1:]:
+            if len(layout[0]) != len(contours):
+                return "%d contours in %s, %d in %s" % (
+                    len(contours), self.names[0], len(layout[0]), name)
+            for i, (points, otherPoints) in enumerate(zip(contours, layout[0])):
+                if points != otherPoints:
+                    return "%d points in contour %d in %s, %d in %s" % (
+                        points, i, self.names[0], otherPoints, name)
+            if layout[1] != components:
+                return "%d components in %s, %d in %s" % (
+                    components, self.names[0], layout[1], name)
+            if layout[2] != anchors:
+                return "%d anchors in %s, %d in %s" % (
+                    anchors, self.names[0], layout[2], name)
+        return None
+
+    def report(self):
+        """Return lines summing up the index, and one per incompatible glyph."""
+
+        lines = ["%s: %d of %d glyphs compatible" % (
+            ", ".join(self.names), len(self.compatible),
+            len(self.compatible) + len(self.incompatible))]
+        for gname in sorted(self.incompatible):
+            lines.append("  %s: %s" % (gname, self.incompatible[gname]))
+        return lines
+
+
+# indexes by the fonts of their masters, see compatibilityIndex
+_compatibilityIndexes = {}
+
+
+def compatibilityIndex(masters):
+    """Return the CompatibilityIndex of masters, built the first time it's
+    asked for and kept for as long as the masters have the same FFonts (or
+    Mixes), so that every Mix of the same masters shares it."""
+
+    key = tuple(m.mix if m.mix is not None else m.ffont for m in masters)
+    try:
+        return _compatibilityIndexes[key]
+    except KeyError:
+        index = _compatibilityIndexes[key] = CompatibilityIndex(masters)
+        return index
+
+
+def glyphLayout(g):
+    """Return the number of points in each of an FGlyph's contours and its
+    numbers of components and anchors, which masters have to agree on."""
+
+    return (tuple(len(c) for c in g.contours), len(g.components),
+            len(g.anchors))
+
+
+def openMasterFont(path, overlayPath=None):
+    """Open a master's UFO, with glyphs mixing contours and components
+    decomposed and the glyphs of the overlay UFO, if any, inserted."""
+
+    font = OpenFont(path)
+    for g in font:
+      size = len(g)
+      csize = len(g.components)
+      if (size > 0 and csize > 0):
+        decomposeGlyph(font, g.name)
+
+    if overlayPath != None:
+        overlayFont = OpenFont(overlayPath)
+        for overlayGlyph in overlayFont:
+            font.insertGlyph(overlayGlyph)
+    return font
+
+
+def roundValues(values):
+    """Round an array like int(round(v)) for each value, i.e. halves away
+    from zero, and return the values as a list of ints."""
+
+    magnitudes = abs(values)
+    rounded = floor(magnitudes)
+    rounded += magnitudes - rounded >= .5
+    return (sign(values) * rounded).astype(int).tolist()
+
+
 def narrowFLGlyph(g, gThin, factor=.75):
     gF = FGlyph(g)
     if not isinstance(gThin,FGlyph):
@@ -354,4 +871,5 @@ def interpolateKerns(kA, kB, v):
     #    else:
     #        kerns[pair] = lerped_val
     #return kerns
-    return dict(kA)
+    # KerningTables don't change, so kA can be shared
+    return kA
@@ -0,0 +1,359 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Detection of glyphs which need their overlaps removed.
+
+A glyph can skip the boolean union if its contours neither cross nor touch
+each other or themselves, and if they already wind the way the union would
+leave them: outer contours counter-clockwise, alternating with every level
+of nesting. Anything doubtful (quadratic curves, degenerate segments, curves
+too close to tell apart) counts as an overlap.
+
+Pairs of segments are culled by the bounding boxes of their control points,
+and the remaining pairs are split into flatter pieces only where their boxes
+still overlap.
+"""
+
+
+# curves are flattened until their control points are this close to the
+# chords, so that the flattened curves are at most this far from the real ones
+FLATNESS = 0.25
+
+# flattened segments closer than this may belong to intersecting curves
+TOLERANCE = 2 * FLATNESS
+
+# contours with a smaller area are left to the union, which removes them
+MIN_AREA = 1.0
+
+
+def hasOverlaps(glyph):
+    """Return whether a RoboFab glyph may have overlapping contours."""
+
+    contours = []
+    for contour in glyph:
+        segments = contourSegments(contour)
+        if segments is None or abs(contourArea(segments)) < MIN_AREA:
+            return True
+        contours.append(segments)
+    if not contours:
+        return False
+    return segmentsIntersect(contours) or not windsLikeUnion(contours)
+
+
+def contourSegments(contour):
+    """Return a contour's segments as tuples of 2 or 4 points.
+
+    Returns None for contours the union would simplify (zero-length segments,
+    curves with both handles retracted) or which aren't cubic. RoboFab marks
+    the first point of every contour as a "move", and closes contours with a
+    curve if there are off-curve points at the end of the list.
+    """
+
+    points = [(float(p.x), float(p.y), p.type) for p in contour.points]
+    if any(p[2] not in ("move", "line", "curve", "offcurve") for p in points):
+        return None
+    onCurves = [i for i, p in enumerate(points) if p[2] != "offcurve"]
+    if not onCurves:
+        return None
+
+    # start right after the last on-curve point, so that the off-curve
+    # points at the end of the list end up before the first on-curve point
+    last = onCurves[-1]
+    points = points[last + 1:] + points[:last + 1]
+    current = points[-1][:2]
+    segments = []
+    offCurves = []
+    for x, y, pointType in points:
+        if pointType == "offcurve":
+            offCurves.append((x, y))
+            continue
+        if (x, y) == current or len(offCurves) not in (0, 2):
+            return None
+        if offCurves == [current, (x, y)]:
+            return None
+        segments.append(tuple([current] + offCurves + [(x, y)]))
+        current = (x, y)
+        offCurves = []
+    return segments if len(segments) > 1 else None
+
+
+def contourArea(segments):
+    """Return the signed area of a contour, positive if counter-clockwise."""
+
+    area = 0
+    for segment in segments:
+        x0, y0 = segment[0]
+        if len(segment) == 4:
+            # https://github.com/Pomax/bezierinfo/issues/44
+            x1, y1 = segment[1][0] - x0, segment[1][1] - y0
+            x2, y2 = segment[2][0] - x0, segment[2][1] - y0
+            x3, y3 = segment[3][0] - x0, segment[3][1] - y0
+            area += (x1 * (-y2 - y3) + x2 * (y1 - 2 * y3) +
+                     x3 * (y1 + 2 * y2)) * 0.15
+        x1, y1 = segment[-1]
+        area += (x0 * y1 - x1 * y0) * 0.5
+    return area
+
+
+def segmentsIntersect(contours):
+    """Return whether any segments of the contours (nearly) touch.
+
+    Candidate pairs are found by sweeping the segments' bounding boxes along
+    x, and only those are compared in detail.
+    """
+
+    boxes = []
+    for c, segments in enumerate(contours):
+        for i, segment in enumerate(segments):
+            if len(segment) == 4 and mayLoop(segment) and curveLoops(segment):
+                return True
+            xMin, yMin, xMax, yMax = boundingBox(segment)
+            boxes.append((xMin - TOLERANCE, xMax + TOLERANCE,
+                          yMin - TOLERANCE, yMax + TOLERANCE, c, i))
+    boxes.sort()
+
+    active = []
+    for box in boxes:
+        xMin, xMax, yMin, yMax, c, i = box
+        active = [b for b in active if b[1] >= xMin]
+        for other in active:
+            if other[2] > yMax or other[3] < yMin:
+                continue
+            oc, oi = other[4:]
+            a, b = contours[c][i], contours[oc][oi]
+            count = len(contours[c])
+            if oc == c and (oi - i) % count == 1:
+                near = segmentsNear(a, b, joined=True)
+            elif oc == c and (i - oi) % count == 1:
+                near = segmentsNear(b, a, joined=True)
+            else:
+                near = segmentsNear(a, b)
+            if near:
+                return True
+        active.append(box)
+    return False
+
+
+def segmentsNear(a, b, joined=False):
+    """Return whether two segments cross or come within TOLERANCE.
+
+    Curves are split in halves until the pieces are flat enough to be
+    compared as lines, but only where the pieces' bounding boxes overlap.
+    If joined, a ends where b starts and they may only meet there.
+    """
+
+    stack = [(a, b, joined)]
+    while stack:
+        a, b, joined = stack.pop()
+        if joined and separatedAtJoint(a, b):
+            continue
+        if not boxesNear(boundingBox(a), boundingBox(b)):
+            continue
+        aFlat, bFlat = isFlat(a), isFlat(b)
+        if aFlat and bFlat:
+            if joined:
+                if folds(a[0], a[-1], b[-1]):
+                    return True
+            elif linesNear(a[0], a[-1], b[0], b[-1]):
+                return True
+        elif not aFlat and (bFlat or chordLength(a) >= chordLength(b)):
+            first, second = splitCurve(a)
+            stack.append((first, b, False))
+            stack.append((second, b, joined))
+        else:
+            first, second = splitCurve(b)
+            stack.append((a, second, False))
+            stack.append((a, first, joined))
+    return False
+
+
+def separatedAtJoint(a, b):
+    """Return whether segment a, which ends where b starts, and b are on
+    opposite sides of a line through that point.
+
+    The line is perpendicular to the mean of their tangents there, so this
+    holds for most smooth joins and corners, and segments on opposite sides
+    can't meet anywhere else.
+    """
+
+    joint = a[-1]
+    before = [p for p in a if p != joint]
+    after = [p for p in b if p != joint]
+    ax, ay = unitVector(before[-1], joint)
+    bx, by = unitVector(joint, after[0])
+    nx, ny = ax + bx, ay + by
+    return (all((p[0] - joint[0]) * nx + (p[1] - joint[1]) * ny < 0
+                for p in before) and
+            all((p[0] - joint[0]) * nx + (p[1] - joint[1]) * ny > 0
+                for p in after))
+
+
+def unitVector(a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = (dx * dx + dy * dy) ** 0.5
+    return dx / length, dy / length
+
+
+def curveLoops(curve):
+    """Return whether a cubic curve (nearly) touches itself."""
+
+    if isFlat(curve):
+        return False
+    first, second = splitCurve(curve)
+    return (mayLoop(first) and curveLoops(first) or
+            mayLoop(second) and curveLoops(second) or
+            segmentsNear(first, second, joined=True))
+
+
+def mayLoop(curve):
+    """Return whether a cubic curve's control polygon isn't convex.
+
+    Curves with a convex control polygon can't intersect themselves.
+    """
+
+    p0, p1, p2, p3 = curve
+    turns = [cross(p0, p1, p2), cross(p1, p2, p3), cross(p2, p3, p0),
+             cross(p3, p0, p1)]
+    return not (all(t >= 0 for t in turns) or all(t <= 0 for t in turns))
+
+
+def isFlat(segment):
+    """Return whether a segment is within FLATNESS of its chord.
+
+    Curves lie within the convex hull of their control points, so they are
+    if their off-curve points are.
+    """
+
+    if len(segment) == 2:
+        return True
+    p0, p1, p2, p3 = segment
+    return (distanceToSegment(p1, p0, p3) < FLATNESS and
+            distanceToSegment(p2, p0, p3) < FLATNESS)
+
+
+def splitCurve(curve):
+    """Split a cubic curve in halves (de Casteljau's algorithm at t = 0.5)."""
+
+    p0, p1, p2, p3 = curve
+    p01, p12, p23 = midpoint(p0, p1), midpoint(p1, p2), midpoint(p2, p3)
+    p012, p123 = midpoint(p01, p12), midpoint(p12, p23)
+    p0123 = midpoint(p012, p123)
+    return (p0, p01, p012, p0123), (p0123, p123, p23, p3)
+
+
+def flattenContour(segments):
+    """Return a contour as a closed polygon, within FLATNESS of the curves."""
+
+    polygon = []
+    for segment in segments:
+        stack = [segment]
+        while stack:
+            segment = stack.pop()
+            if isFlat(segment):
+                polygon.append(segment[-1])
+            else:
+                first, second = splitCurve(segment)
+                stack.append(second)
+                stack.append(first)
+    return polygon
+
+
+def midpoint(a, b):
+    return (a[0] + b[0]) * 0.5, (a[1] + b[1]) * 0.5
+
+
+def chordLength(segment):
+    (x0, y0), (x1, y1) = segment[0], segment[-1]
+    return abs(x1 - x0) + abs(y1 - y0)
+
+
+def boundingBox(segment):
+    xs = [p[0] for p in segment]
+    ys = [p[1] for p in segment]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def boxesNear(a, b):
+    return (a[0] - TOLERANCE <= b[2] and b[0] - TOLERANCE <= a[2] and
+            a[1] - TOLERANCE <= b[3] and b[1] - TOLERANCE <= a[3])
+
+
+def folds(p, q, r):
+    """Return whether lines pq and qr fold back onto each other."""
+
+    return (distanceToSegment(p, q, r) < TOLERANCE or
+            distanceToSegment(r, p, q) < TOLERANCE)
+
+
+def linesNear(a, b, c, d):
+    """Return whether lines ab and cd cross or are within TOLERANCE."""
+
+    if (cross(a, b, c) * cross(a, b, d) < 0 and
+            cross(c, d, a) * cross(c, d, b) < 0):
+        return True
+    return min(distanceToSegment(a, c, d), distanceToSegment(b, c, d),
+               distanceToSegment(c, a, b),
+               distanceToSegment(d, a, b)) < TOLERANCE
+
+
+def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def distanceToSegment(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length2 = dx * dx + dy * dy
+    t = 0
+    if length2:
+        t = max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length2))
+    x, y = a[0] + t * dx - p[0], a[1] + t * dy - p[1]
+    return (x * x + y * y) ** 0.5
+
+
+def windsLikeUnion(contours):
+    """Return whether non-intersecting contours have union's directions.
+
+    Contours at even nesting depths must be counter-clockwise and the others
+    clockwise; anything else (e.g. a contour inside another with the same
+    direction) would be changed by the union.
+    """
+
+    boxes = [boundingBox([p for segment in segments for p in segment])
+             for segments in contours]
+    polygons = {}
+    for c, segments in enumerate(contours):
+        point = segments[0][0]
+        depth = 0
+        for other, box in enumerate(boxes):
+            if (other != c and box[0] <= point[0] <= box[2] and
+                    box[1] <= point[1] <= box[3]):
+                if other not in polygons:
+                    polygons[other] = flattenContour(contours[other])
+                if pointInPolygon(point, polygons[other]):
+                    depth += 1
+        if (contourArea(segments) > 0) != (depth % 2 == 0):
+            return False
+    return True
+
+
+def pointInPolygon(point, polygon):
+    x, y = point
+    inside = False
+    x0, y0 = polygon[-1]
+    for x1, y1 in polygon:
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+        x0, y0 = x1, y1
+    return inside
@@ -0,0 +1,71 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Timing of build stages, saved in Chrome's trace event format.
+
+The saved files can be opened in chrome://tracing, and their "X" (complete)
+events summed up per stage name to track regressions.
+"""
+
+
+from contextlib import contextmanager
+import json
+import os
+import thread
+import time
+
+
+class BuildTrace:
+    """Records how long each build stage took."""
+
+    def __init__(self):
+        self.events = []
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block as a stage.
+
+        Yields the args dict attached to the event, so that values only known
+        at the end of the stage (e.g. glyph counts) can still be added.
+        """
+
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                "name": name, "ph": "X", "pid": os.getpid(),
+                "tid": thread.get_ident(), "ts": int(start * 1e6),
+                "dur": int((time.time() - start) * 1e6), "args": args})
+
+    def save(self, path):
+        with open(path, "w") as traceFile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"},
+                      traceFile)
+
+    def summary(self):
+        """Return table lines with the count and timings of each stage."""
+
+        stages = {}
+        for event in self.events:
+            stages.setdefault(event["name"], []).append(event["dur"] / 1e6)
+        lines = ["%-24s %6s %10s %10s %10s" % (
+            "stage", "count", "total (s)", "mean (s)", "max (s)")]
+        for name, times in sorted(
+                stages.items(), key=lambda item: -sum(item[1])):
+            lines.append("%-24s %6d %10.2f %10.2f %10.2f" % (
+                name, len(times), sum(times), sum(times) / len(times),
+                max(times)))
+        return lines
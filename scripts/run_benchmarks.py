@@ -0,0 +1,292 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Time the stages of the fontbuild pipeline one at a time.
+
+Each stage runs on glyphs or fonts made from the v2 masters, a few times,
+and its best time is reported as JSON along with its throughput in glyphs
+(and fonts) per second. Given a baseline saved by an earlier run, stages
+which got slower per glyph by more than the threshold fail the run.
+"""
+
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from cu2qu.ufo import fonts_to_quadratic
+
+from fontbuild.Build import (
+    FontProject, TTF_MAX_ERR, generateGlyphs, matchSavedFont,
+    removeGlyphOverlap, saveOTF)
+from fontbuild.curveFitPen import fitGlyph, segmentContours, segmentGlyph
+from fontbuild.features import readFeatureFile
+from fontbuild.italics import italicize, italicizeGlyphs, italicTransform
+from fontbuild.mix import Master, Mix
+
+# The root of the Roboto tree
+BASEDIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir))
+
+INSTANCE = "Roboto/Light/Regular/Lt"
+
+
+class Fixtures:
+    """Masters, mixed glyphs and finished fonts shared by the stages."""
+
+    def __init__(self, sampleSize):
+        self.thin = Master("%s/src/v2/Roboto-Thin.ufo" % BASEDIR)
+        self.regular = Master("%s/src/v2/Roboto-Regular.ufo" % BASEDIR)
+        self.mix = Mix([self.thin, self.regular], 0.45)
+        self.project = FontProject(
+            self.regular.font, BASEDIR, "res/roboto.cfg")
+
+        # the instance as it is before any of the timed stages
+        self.mixed = self.mix.generateFont(self.regular.font)
+        self.glyphNames = sorted(self.mixed.keys())
+
+        # glyphs as they are italicized, i.e. without overlaps
+        withContours = [
+            name for name in self.glyphNames if len(self.mixed[name]) > 0]
+        step = max(1, len(withContours) / sampleSize)
+        self.sample = []
+        for name in withContours[::step][:sampleSize]:
+            g = self.mixed[name].copy()
+            removeGlyphOverlap(g)
+            self.sample.append(g)
+
+        # the finished instance, as handed to the TTF stages
+        self.tempDir = tempfile.mkdtemp()
+        self.project.builddir = self.tempDir
+        self.project.inMemory = True
+        self.project.saveUFO = False
+        ufoName = self.project.buildFont(self.mix, INSTANCE)
+        self.font = self.project.openGeneratedFont(ufoName)
+        self.quadraticFont = self.font.copy()
+        fonts_to_quadratic(
+            [self.quadraticFont], max_err_em=TTF_MAX_ERR,
+            reverse_direction=True)
+
+    def close(self):
+        shutil.rmtree(self.tempDir)
+
+
+def defineStages(fx):
+    """Return the stages as (name, setup, run, glyph count, font count).
+
+    run is timed on whatever setup returns, which isn't timed. The font
+    count is None for stages which only run on some glyphs.
+    """
+
+    stages = []
+
+    def stage(name, glyphCount, fontCount=None, setup=lambda: None):
+        def register(run):
+            stages.append((name, setup, run, glyphCount, fontCount))
+            return run
+        return register
+
+    @stage("mixGlyphs", len(fx.glyphNames), 1)
+    def mixGlyphs(unused):
+        for name in fx.glyphNames:
+            fx.mix.mixGlyphs(name)
+
+    # a new Mix every round, as a Mix keeps the glyphs it mixed
+    @stage("generateFont", len(fx.glyphNames), 1,
+           lambda: Mix([fx.thin, fx.regular], 0.45))
+    def generateFont(mix):
+        mix.generateFont(fx.regular.font)
+
+    @stage("removeGlyphOverlap", len(fx.glyphNames), 1, fx.mixed.copy)
+    def removeOverlaps(f):
+        for g in f:
+            removeGlyphOverlap(g)
+
+    @stage("segmentGlyph", len(fx.sample))
+    def segmentGlyphs(unused):
+        for g in fx.sample:
+            segmentGlyph(g, 25)
+
+    @stage("segmentContours", len(fx.sample))
+    def segmentContourArrays(unused):
+        for g in fx.sample:
+            segmentContours(g, 25)
+
+    @stage("fitGlyph", len(fx.sample),
+           setup=lambda: [segmentGlyph(g, 25) for g in fx.sample])
+    def fitGlyphs(segmented):
+        for g, (ga, subsegments) in zip(fx.sample, segmented):
+            fitGlyph(g, ga, subsegments)
+
+    @stage("italicize", len(fx.sample))
+    def italicizeSample(unused):
+        xoffset, unused = italicTransform(10)
+        for g in fx.sample:
+            italicize(g, 10, stemWidth=185, xoffset=xoffset)
+
+    @stage("italicizeGlyphs", len(fx.sample))
+    def italicizeBatch(unused):
+        xoffset, unused = italicTransform(10)
+        italicizeGlyphs(fx.sample, 10, stemWidth=185, xoffset=xoffset)
+
+    @stage("generateGlyphs", len(fx.glyphNames), 1, fx.mixed.copy)
+    def generateAllGlyphs(f):
+        generateGlyphs(
+            f, fx.project.diacriticList, fx.project.adobeGlyphList)
+
+    def resetFeatures():
+        fx.mixed.features.text = fx.regular.font.features.text
+        return fx.mixed
+
+    @stage("readFeatureFile", len(fx.glyphNames), 1, resetFeatures)
+    def readFeatures(f):
+        readFeatureFile(f, fx.regular.font.features.text)
+
+    @stage("fonts_to_quadratic", len(fx.font.keys()), 1, fx.font.copy)
+    def convertToQuadratic(f):
+        fonts_to_quadratic([f], max_err_em=TTF_MAX_ERR, reverse_direction=True)
+
+    def copyQuadraticFont():
+        f = fx.quadraticFont.copy()
+        matchSavedFont(f)
+        return f
+
+    @stage("compileTTF", len(fx.font.keys()), 1, copyQuadraticFont)
+    def compileTTF(f):
+        saveOTF(f, os.path.join(fx.tempDir, "Roboto-Light.ttf"),
+                fx.project.glyphOrder, truetype=True)
+
+    return stages
+
+
+def timeStage(setup, run, rounds):
+    """Return the best time of run over a few rounds, without setup."""
+
+    times = []
+    for i in range(rounds):
+        data = setup()
+        start = time.time()
+        run(data)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def runStages(fx, names, rounds):
+    """Time the given stages, or all stages, and return their results."""
+
+    results = {}
+    for name, setup, run, glyphCount, fontCount in defineStages(fx):
+        if names and name not in names:
+            continue
+        print >>sys.stderr, "Timing %s..." % name
+        seconds = timeStage(setup, run, rounds)
+        results[name] = {
+            "seconds": seconds, "glyphs": glyphCount,
+            "secondsPerGlyph": seconds / glyphCount,
+            "glyphsPerSecond": glyphCount / seconds}
+        if fontCount is not None:
+            results[name]["fontsPerSecond"] = fontCount / seconds
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return report lines and the names of stages which got slower.
+
+    Stages are compared by time per glyph, so that baselines taken with
+    another sample size still apply.
+    """
+
+    lines = ["%-20s %12s %12s %8s" % (
+        "stage", "baseline (s)", "now (s)", "change")]
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            lines.append("%-20s %12s %12.3f" % (name, "-", result["seconds"]))
+            continue
+        change = (result["secondsPerGlyph"] / old["secondsPerGlyph"]) - 1
+        lines.append("%-20s %12.3f %12.3f %+7.1f%%" % (
+            name, old["seconds"], result["seconds"], change * 100))
+        if change > threshold:
+            regressions.append(name)
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--stages", nargs="+", metavar="STAGE",
+        help="only run these stages (default: all)")
+    parser.add_argument(
+        "--rounds", type=int, default=3,
+        help="times to run each stage, keeping the best (default: 3)")
+    parser.add_argument(
+        "--glyphs", type=int, default=200,
+        help="number of glyphs for stages which don't run on whole fonts "
+             "(default: 200)")
+    parser.add_argument(
+        "--output", metavar="FILE",
+        help="where to save the results (default: standard output)")
+    parser.add_argument(
+        "--baseline", metavar="FILE",
+        help="results of an earlier run to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="slowdown per glyph, relative to the baseline, from which a "
+             "stage counts as regressed (default: 0.1)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)["stages"]
+
+    # the stages log plenty, which shouldn't end up in the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        print >>sys.stderr, "Loading fixtures..."
+        fx = Fixtures(args.glyphs)
+        try:
+            results = runStages(fx, args.stages, args.rounds)
+        finally:
+            fx.close()
+    finally:
+        sys.stdout = stdout
+
+    report = {"rounds": args.rounds, "stages": results}
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if baseline is not None:
+        lines, regressions = compare(results, baseline, args.threshold)
+        for line in lines:
+            print >>sys.stderr, line
+        if regressions:
+            print >>sys.stderr, "Regressed by more than %d%%: %s" % (
+                args.threshold * 100, ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()